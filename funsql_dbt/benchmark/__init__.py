@@ -0,0 +1,4 @@
+"""
+Benchmarks for the model runner, on synthetic data and model graphs. Run from the
+`funsql_dbt` directory as `python -m benchmark.run --help`.
+"""
@@ -0,0 +1,64 @@
+import csv
+import os
+import random
+from datetime import date, timedelta
+
+# -----------------------------------------------------------
+# deterministic generator for the raw jaffle shop tables, at any
+# scale. Rows are streamed to the csv files, never held in memory.
+# -----------------------------------------------------------
+
+
+FIRST_NAMES = ["Michael", "Shawn", "Kathleen", "Jimmy", "Katherine", "Sarah", "Martin"]
+LAST_INITIALS = [f"{c}." for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+STATUSES = ["completed", "placed", "shipped", "returned", "return_pending"]
+STATUS_WEIGHTS = [67, 13, 13, 4, 3]
+PAYMENT_METHODS = ["credit_card", "bank_transfer", "coupon", "gift_card"]
+PAYMENT_WEIGHTS = [48, 29, 12, 11]
+
+
+def generate_jaffle_shop(
+    out_dir: str, num_orders: int, seed: int = 0
+) -> dict[str, str]:
+    """Write `raw_customers.csv`, `raw_orders.csv` and `raw_payments.csv` to the
+    output directory, with `num_orders` orders from a tenth as many customers, and
+    one or two payments per order. The same seed always produces the same files.
+
+    Returns the path of the csv file for each table.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    num_customers = max(num_orders // 10, 1)
+    paths = {
+        name: os.path.join(out_dir, f"{name}.csv")
+        for name in ["raw_customers", "raw_orders", "raw_payments"]
+    }
+
+    with open(paths["raw_customers"], "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "first_name", "last_name"])
+        for i in range(1, num_customers + 1):
+            writer.writerow([i, rng.choice(FIRST_NAMES), rng.choice(LAST_INITIALS)])
+
+    start = date(2018, 1, 1)
+    payment_id = 0
+    with open(paths["raw_orders"], "w", newline="") as f_orders, open(
+        paths["raw_payments"], "w", newline=""
+    ) as f_payments:
+        orders = csv.writer(f_orders)
+        payments = csv.writer(f_payments)
+        orders.writerow(["id", "user_id", "order_date", "status"])
+        payments.writerow(["id", "order_id", "payment_method", "amount"])
+
+        for i in range(1, num_orders + 1):
+            # orders are spread over about a thousand a day
+            order_date = start + timedelta(days=i // 1000)
+            status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+            orders.writerow([i, rng.randint(1, num_customers), order_date, status])
+
+            for _ in range(1 if rng.random() < 0.85 else 2):
+                payment_id += 1
+                method = rng.choices(PAYMENT_METHODS, PAYMENT_WEIGHTS)[0]
+                payments.writerow([payment_id, i, method, rng.randint(0, 30) * 100])
+
+    return paths
@@ -0,0 +1,74 @@
+from typing import Type
+
+from funsql import *
+
+from lib.with_classes import Context, DataModel
+
+# -----------------------------------------------------------
+# generators for graphs of data models of different shapes, over
+# the raw jaffle shop orders table
+# -----------------------------------------------------------
+
+
+def make_model(
+    name: str, parents: list[Type[DataModel]], materialize: bool = True
+) -> Type[DataModel]:
+    """Create a data model class, selecting the staged order columns. A model with
+    no parents reads the raw orders table, else it joins all its parents on the
+    order id.
+    """
+    fields = [f"parent_{i}" for i in range(len(parents))]
+
+    def query(self, ctx: Context) -> SQLNode:
+        if len(fields) == 0:
+            return From(S.raw_orders) >> Select(
+                aka(Get.id, "order_id"),
+                aka(Get.user_id, "customer_id"),
+                Get.order_date,
+                Get.status,
+            )
+
+        q = getattr(self, fields[0])(ctx)
+        for field in fields[1:]:
+            other = getattr(self, field)(ctx) >> As(field)
+            q = q >> Join(other, on=Fun("=", Get.order_id, Get(field) >> Get.order_id))
+        return q >> Select(Get.order_id, Get.customer_id, Get.order_date, Get.status)
+
+    attrs = {
+        "__annotations__": dict(zip(fields, parents)),
+        "__materialize__": materialize,
+        "__module__": __name__,
+        "query": query,
+    }
+    return type(name, (DataModel,), attrs)
+
+
+def wide_graph(width: int) -> list[Type[DataModel]]:
+    """a single staging model, with `width` independent children"""
+    root = make_model("wide_stg", [], materialize=False)
+    return [make_model(f"wide_{i}", [root]) for i in range(width)]
+
+
+def deep_graph(depth: int, materialize_every: int = 1) -> list[Type[DataModel]]:
+    """a chain of `depth` models, each reading the previous one"""
+    model = make_model("deep_0", [], materialize=True)
+    for i in range(1, depth):
+        materialize = i % materialize_every == 0 or i == depth - 1
+        model = make_model(f"deep_{i}", [model], materialize)
+    return [model]
+
+
+def diamond_graph(width: int, depth: int) -> list[Type[DataModel]]:
+    """`depth` layers of `width` models, each model joining two neighbouring models
+    of the layer above, so every layer fans out and back in
+    """
+    root = make_model("diamond_stg", [], materialize=False)
+    layer = [make_model(f"diamond_0_{j}", [root]) for j in range(width)]
+    for i in range(1, depth):
+        layer = [
+            make_model(
+                f"diamond_{i}_{j}", [layer[j], layer[(j + 1) % width]][: min(width, 2)]
+            )
+            for j in range(width)
+        ]
+    return layer
@@ -0,0 +1,71 @@
+import argparse
+import gc
+import time
+from typing import Any
+
+from tabulate import tabulate
+
+from lib.with_classes import _build_graph, _critical_paths
+
+from .graphs import deep_graph, diamond_graph, wide_graph
+
+# -----------------------------------------------------------
+# time building and planning the graph of models, without any
+# database, to check it scales linearly with the model count
+# -----------------------------------------------------------
+
+
+def plan_graph(shape: str, num_models: int) -> dict[str, Any]:
+    if shape == "wide":
+        models = wide_graph(num_models - 1)
+    elif shape == "deep":
+        models = deep_graph(num_models)
+    else:
+        width = max(1, int(num_models**0.5))
+        models = diamond_graph(width, num_models // width)
+
+    # like timeit, keep collections triggered by the many model classes out of it
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        node_children, node_parent_count = _build_graph(models)
+        plan = {node: node.__materialize__ for node in node_parent_count}
+        _critical_paths(node_children, node_parent_count, {}, plan)
+        elapsed = time.perf_counter() - start
+    finally:
+        gc.enable()
+
+    num_nodes = len(node_parent_count)
+    return {
+        "shape": shape,
+        "models": num_nodes,
+        "edges": sum(node_parent_count.values()),
+        "seconds": elapsed,
+        "us per model": 1e6 * elapsed / num_nodes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=["wide", "deep", "diamond"],
+        default=["wide", "deep", "diamond"],
+    )
+    parser.add_argument(
+        "--models", type=int, nargs="+", default=[1_000, 4_000, 16_000, 64_000]
+    )
+    args = parser.parse_args()
+
+    rows = []
+    for shape in args.shapes:
+        for num_models in args.models:
+            rows.append(plan_graph(shape, num_models))
+    # time per model staying flat as the graph grows means linear scaling
+    print(tabulate(rows, headers="keys", floatfmt=".3f"))
+
+
+if __name__ == "__main__":
+    main()
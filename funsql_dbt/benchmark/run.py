@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Any, Type
+
+from funsql import *
+from tabulate import tabulate
+
+from class_models import DB_CATALOG, customer_final, orders_final
+from lib.backends import Backend, DuckDBBackend, SQLiteBackend
+from lib.seed import seed_tables
+from lib.with_classes import DataModel, populate_tables
+
+from .generate import generate_jaffle_shop
+from .graphs import deep_graph, diamond_graph, wide_graph
+
+# -----------------------------------------------------------
+# time populate_tables end to end, and per phase, across data
+# sizes, model graphs, backends and worker counts
+# -----------------------------------------------------------
+
+
+PAYMENT_METHODS = ["credit_card", "coupon", "bank_transfer", "gift_card"]
+
+
+def make_graph(shape: str, size: int) -> list[Type[DataModel]]:
+    if shape == "jaffle":
+        return [orders_final, customer_final]
+    elif shape == "wide":
+        return wide_graph(size)
+    elif shape == "deep":
+        return deep_graph(size)
+    elif shape == "diamond":
+        return diamond_graph(size, size)
+    raise ValueError(f"unknown graph shape: {shape}")
+
+
+def make_backend(name: str, db_path: str, pool_size: int) -> Backend:
+    if name == "duckdb":
+        return DuckDBBackend(db_path, pool_size=pool_size)
+    return SQLiteBackend(db_path, pool_size=pool_size)
+
+
+def run_benchmark(
+    data_dir: str,
+    backend_name: str,
+    shape: str,
+    size: int,
+    workers: int,
+) -> dict[str, Any]:
+    """seed a fresh database with the csv files in the data directory, and build the
+    models in it, returning the time taken by each phase
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, f"bench.{backend_name}")
+        results_path = os.path.join(tmp_dir, "run_results.json")
+        backend = make_backend(backend_name, db_path, workers)
+        catalog = SQLCatalog(dialect=backend.dialect, tables=DB_CATALOG.tables)
+
+        start = time.perf_counter()
+        seed_tables(backend, catalog, data_dir)
+        seed_time = time.perf_counter() - start
+
+        models = make_graph(shape, size)
+        ctx = {
+            "backend": backend,
+            "catalog": catalog,
+            "payment_methods": PAYMENT_METHODS,
+        }
+        start = time.perf_counter()
+        populate_tables(models, ctx, max_workers=workers, run_results=results_path)
+        run_time = time.perf_counter() - start
+        backend.close()
+
+        with open(results_path) as f:
+            entries = json.load(f)["results"]
+
+    return {
+        "backend": backend_name,
+        "shape": shape,
+        "size": size,
+        "workers": workers,
+        "models": len(entries),
+        "seed": seed_time,
+        "render": sum(e["render_time"] for e in entries),
+        "execute": sum(e.get("execution_time", 0.0) for e in entries),
+        "queue wait": sum(e["queue_wait"] for e in entries),
+        "end to end": run_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=float, nargs="+", default=[1e3, 1e5])
+    parser.add_argument("--backends", nargs="+", default=["sqlite", "duckdb"])
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=["jaffle", "wide", "deep", "diamond"],
+        default=["jaffle", "wide", "deep", "diamond"],
+    )
+    parser.add_argument("--size", type=int, default=8, help="size of generated graphs")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--data-dir", default=os.path.join(tempfile.gettempdir(), "jaffle")
+    )
+    parser.add_argument("--output", help="also write the results to a json file")
+    args = parser.parse_args()
+
+    rows = []
+    for num_rows in args.rows:
+        data_dir = os.path.join(args.data_dir, str(int(num_rows)))
+        if not os.path.exists(os.path.join(data_dir, "raw_payments.csv")):
+            generate_jaffle_shop(data_dir, int(num_rows))
+
+        for backend_name in args.backends:
+            for shape in args.shapes:
+                for workers in args.workers:
+                    result = run_benchmark(
+                        data_dir, backend_name, shape, args.size, workers
+                    )
+                    rows.append({"rows": int(num_rows), **result})
+                    print(
+                        f"rows={int(num_rows)} backend={backend_name} shape={shape} "
+                        f"workers={workers}: {result['end to end']:.3f}s"
+                    )
+
+    print()
+    print(tabulate(rows, headers="keys", floatfmt=".3f"))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
+import argparse
 import os
-import sqlite3
+import sys
 from typing import Any
 
 from funsql import *
 from funsql.tools import dialect_sqlite
 
+from lib.backends import DuckDBBackend, SQLiteBackend
+from lib.catalog import CatalogLoader
+from lib.compiler import dialect_duckdb
+from lib.seed import seed_tables
 from lib.with_classes import DataModel, Context, populate_tables
 
 
@@ -170,23 +175,62 @@ class orders_final(DataModel):
 
 
 if __name__ == "__main__":
-    # set up the sqlite database if it didn't exist
-    DB_FILE = "/tmp/funsql_class_models.db"
-    db_exists = os.path.exists(DB_FILE)
-    if not db_exists:
-        import pandas as pd
-
-        # create tables for csv files
-        conn = sqlite3.connect(DB_FILE)
-        pd.read_csv("raw_customers.csv").to_sql("raw_customers", conn)
-        pd.read_csv("raw_orders.csv").to_sql("raw_orders", conn)
-        pd.read_csv("raw_payments.csv").to_sql("raw_payments", conn)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command", choices=["run", "seed", "compile"], nargs="?", default="run"
+    )
+    parser.add_argument("--backend", choices=["sqlite", "duckdb"], default="sqlite")
+    parser.add_argument("--select", nargs="+", help="e.g. +orders_final")
+    parser.add_argument("--defer", action="store_true")
+    parser.add_argument("--resume", action="store_true", help="continue failed run")
+    args = parser.parse_args()
+    payment_methods = ["credit_card", "coupon", "bank_transfer", "gift_card"]
+
+    if args.command == "compile":
+        # only renders the SQL for each model, so no database is needed
+        dialect = dialect_duckdb() if args.backend == "duckdb" else DB_CATALOG.dialect
+        plan_file = "/tmp/funsql_class_models_plan.json"
+        populate_tables(
+            [orders_final, customer_final],
+            {
+                "catalog": SQLCatalog(dialect=dialect, tables=DB_CATALOG.tables),
+                "payment_methods": payment_methods,
+            },
+            max_workers=4,
+            select=args.select,
+            execute=False,
+            plan_file=plan_file,
+        )
+        print(f"compiled models written to {plan_file}")
+        sys.exit(0)
+
+    if args.backend == "duckdb":
+        DB_FILE = "/tmp/funsql_class_models.duckdb"
+        db_exists = os.path.exists(DB_FILE)
+        backend = DuckDBBackend(DB_FILE, pool_size=4)
+    else:
+        DB_FILE = "/tmp/funsql_class_models.db"
+        db_exists = os.path.exists(DB_FILE)
+        backend = SQLiteBackend(DB_FILE, pool_size=4)
+
+    # create tables for csv files, if the database didn't exist
+    if args.command == "seed" or not db_exists:
+        seed_tables(backend, DB_CATALOG, ".")
+    if args.command == "seed":
+        backend.close()
+        sys.exit(0)
 
     populate_tables(
         [orders_final, customer_final],
         {
-            "db_path": DB_FILE,
-            "catalog": DB_CATALOG,
-            "payment_methods": ["credit_card", "coupon", "bank_transfer", "gift_card"],
+            "backend": backend,
+            # the tables seeded and built so far, read from the database
+            "catalog_loader": CatalogLoader(backend),
+            "payment_methods": payment_methods,
         },
+        max_workers=4,
+        select=args.select,
+        defer=args.defer,
+        resume=args.resume,
     )
+    backend.close()
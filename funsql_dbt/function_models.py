@@ -1,10 +1,15 @@
+import argparse
 import os
-import sqlite3
-from functools import wraps
+import sys
 
 from funsql import *
 from funsql.tools import dialect_sqlite
 
+from lib.backends import DuckDBBackend, SQLiteBackend
+from lib.catalog import CatalogLoader
+from lib.seed import seed_tables
+from lib.with_functions import materialize, model, populate_functions
+
 
 TABLE_CUSTOMERS = SQLTable(S.raw_customers, [S.id, S.first_name, S.last_name])
 TABLE_ORDERS = SQLTable(S.raw_orders, [S.id, S.user_id, S.order_date, S.status])
@@ -21,61 +26,13 @@ DB_CATALOG = SQLCatalog(
 )
 DB_FILE = "/tmp/funsql_function_models.db"
 
-# -----------------------------------------------------------
-# Prefect utilities
-# -----------------------------------------------------------
-
-
-def db_create_table(table_name: str, query_rendered: str):
-    conn = sqlite3.connect(DB_FILE)
-
-    with conn:
-        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-
-    query_str = f"CREATE TABLE {table_name} AS {query_rendered}"
-    try:
-        with conn:
-            conn.execute(query_str)
-    except sqlite3.OperationalError as e:
-        print(f"query err-ing:\n{query_str}\n")
-        raise e
-
-    curr = conn.cursor()
-    curr.execute(f"SELECT * FROM {table_name} LIMIT 0")
-    col_names: list[str] = [desc[0] for desc in curr.description]
-    conn.close()
-
-    return col_names
-
-
-def materialize(table_name: str):
-    """Decorator for prefect task"""
-
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # create prefect task to create a sqlite table for the query
-            # make a query to fetch the schema of the table
-            # create an SQLTable object from the output and return
-
-            query: SQLNode = func(*args, **kwargs)
-            query_rendered: SQLString = render(query, catalog=DB_CATALOG)  # type: ignore
-            col_names = db_create_table(table_name, query_rendered.query)
-            return From(
-                SQLTable(S(table_name), [S(col_name) for col_name in col_names])
-            )  # wrapped in a From node, since the children query uses it directly
-
-        return wrapper
-
-    return decorator
-
-
 # -----------------------------------------------------------
 # Define the views/tables that need to be materialized in the
 # database
 # -----------------------------------------------------------
 
 
+@model
 def get_stg_orders():
     return From(S.raw_orders) >> Select(
         aka(Get.id, "order_id"),
@@ -85,6 +42,7 @@ def get_stg_orders():
     )
 
 
+@model
 def get_stg_customers():
     return From(S.raw_customers) >> Select(
         aka(Get.id, "customer_id"),
@@ -93,6 +51,7 @@ def get_stg_customers():
     )
 
 
+@model
 def get_stg_payments():
     return (
         From(S.raw_payments)
@@ -103,6 +62,7 @@ def get_stg_payments():
     )
 
 
+@model
 def get_customer_orders():
     orders = get_stg_orders()
     return (
@@ -204,17 +164,29 @@ def run_final_models():
 
 
 if __name__ == "__main__":
-    # set up the sqlite database if it didn't exist
-    db_exists = os.path.exists(DB_FILE)
-    conn = sqlite3.connect(DB_FILE)
-
-    if not db_exists:
-        import pandas as pd
-
-        # create tables for csv files
-        pd.read_csv("raw_customers.csv").to_sql("raw_customers", conn)
-        pd.read_csv("raw_orders.csv").to_sql("raw_orders", conn)
-        pd.read_csv("raw_payments.csv").to_sql("raw_payments", conn)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["run", "seed"], nargs="?", default="run")
+    parser.add_argument("--backend", choices=["sqlite", "duckdb"], default="sqlite")
+    args = parser.parse_args()
+
+    if args.backend == "duckdb":
+        DB_FILE = "/tmp/funsql_function_models.duckdb"
+        db_exists = os.path.exists(DB_FILE)
+        BACKEND = DuckDBBackend(DB_FILE, pool_size=4)
+    else:
+        db_exists = os.path.exists(DB_FILE)
+        BACKEND = SQLiteBackend(DB_FILE, pool_size=4)
+
+    # create tables for csv files, if the database didn't exist
+    if args.command == "seed" or not db_exists:
+        seed_tables(BACKEND, DB_CATALOG, ".")
+    if args.command == "seed":
+        BACKEND.close()
+        sys.exit(0)
 
     # run the prefect flow, which should recursively materialize the marked table deps
-    run_final_models()
+    # a dry pass over the models finds the dependencies, so tables are created in
+    # parallel once their parents are done
+    catalog = CatalogLoader(BACKEND).load()
+    populate_functions([run_final_models], BACKEND, catalog, max_workers=4)
+    BACKEND.close()
@@ -0,0 +1,552 @@
+import asyncio
+import csv
+import hashlib
+import itertools
+import json
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Iterator, Optional
+
+from funsql import SQLDialect
+from funsql.tools import dialect_sqlite, reflect_default, reflect_sqlite
+
+from .compiler import dialect_duckdb
+
+
+# -----------------------------------------------------------
+# Backends hold a pool of connections to the database the models
+# are materialized in, reused across all the models in a run.
+# -----------------------------------------------------------
+
+
+# length of the text of a date value kept by each partition grain
+PARTITION_GRAINS = {"day": 10, "month": 7, "year": 4}
+
+
+class Backend:
+    """Base class for a database to materialize models in. Subclasses implement
+    how to open a connection, and the bits of SQL that differ across databases.
+
+    Databases allowing a single writer at a time set `single_writer`, and the
+    statements writing to them are serialized by the backend, rather than failing
+    on a database locked by a long running query.
+
+    At most `pool_size` connections are open at a time. Idle connections are kept
+    around, so the cost of connecting and setting up the session is paid once per
+    connection. Those idle for longer than `health_check_after` seconds are checked
+    with a cheap query before being handed out again. A connection that errored is
+    closed rather than returned to the pool.
+    """
+
+    pool_size: int
+    dialect: SQLDialect  # to render queries for this database
+    default_column_type: str = ""  # for seeded columns without a declared type
+    health_check_after: float = 30.0
+    single_writer: bool = False
+
+    def __init__(self, pool_size: int = 1) -> None:
+        self.pool_size = pool_size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._write_lock = threading.Lock()
+        self._async_slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def connect(self) -> Any:
+        """open a new connection, with any session settings applied"""
+        raise NotImplementedError
+
+    def is_healthy(self, conn: Any) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchall()
+            return True
+        except Exception:
+            return False
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        self._slots.acquire()
+        conn = None
+        try:
+            while conn is None:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    # none left idle, a new one is opened below
+                    break
+                idle_for = time.monotonic() - idle_since
+                if idle_for > self.health_check_after and not self.is_healthy(conn):
+                    _close_quietly(conn)
+                    conn = None
+            if conn is None:
+                conn = self.connect()
+
+            yield conn
+            self._idle.put((conn, time.monotonic()))
+        except BaseException:
+            # the connection might be mid-transaction, don't hand it out again
+            if conn is not None:
+                _close_quietly(conn)
+            raise
+        finally:
+            self._slots.release()
+
+    def async_slots(self) -> asyncio.Semaphore:
+        """Semaphore shared by all the async builds on this backend in the running
+        event loop, letting as many queries run at a time as there are connections.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_slots:
+            self._async_slots[loop] = asyncio.Semaphore(self.pool_size)
+        return self._async_slots[loop]
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """held while writing to the database, if it only allows a single writer"""
+        if not self.single_writer:
+            yield
+            return
+        with self._write_lock:
+            yield
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            _close_quietly(conn)
+
+    def execute(self, query: str, params: tuple = ()) -> list[tuple]:
+        """run a single statement in its own transaction, and return the rows"""
+        reads = query.lstrip()[:6].upper() in ("SELECT", "PRAGMA")
+        with self.connection() as conn, nullcontext() if reads else self.writing():
+            curr = conn.cursor()
+            curr.execute(query, params)
+            rows = curr.fetchall() if curr.description is not None else []
+            conn.commit()
+            return rows
+
+    def create_table(
+        self,
+        table_name: str,
+        query_rendered: str,
+        strategy: str = "replace",
+        params: tuple = (),
+    ) -> None:
+        """Create (or replace) a table with the output of a query, run with `params`
+        bound to its variables.
+
+        With the `replace` strategy, the existing table is dropped first, so readers
+        find no table while the query runs. With `swap`, the query output is written
+        to a scratch table, which then replaces the existing one in a single
+        transaction. Readers see the old table until the new one is ready, and a
+        failed build leaves the old table in place.
+        """
+        assert strategy in ("replace", "swap"), f"unknown strategy: {strategy}"
+        target = f"{table_name}__funsql_tmp" if strategy == "swap" else table_name
+
+        with self.connection() as conn, self.writing():
+            curr = conn.cursor()
+            curr.execute(f"DROP TABLE IF EXISTS {target}")
+            conn.commit()
+
+            query_str = f"CREATE TABLE {target} AS {query_rendered}"
+            try:
+                curr.execute(query_str, params)
+                conn.commit()
+            except Exception as e:
+                print(f"query err-ing:\n{query_str}\n")
+                raise e
+
+            if strategy == "swap":
+                curr.execute("BEGIN")
+                try:
+                    curr.execute(f"DROP TABLE IF EXISTS {table_name}")
+                    curr.execute(f"ALTER TABLE {target} RENAME TO {table_name}")
+                    curr.execute("COMMIT")
+                except Exception:
+                    curr.execute("ROLLBACK")
+                    curr.execute(f"DROP TABLE IF EXISTS {target}")
+                    raise
+
+    def insert_rows(
+        self,
+        table_name: str,
+        query_rendered: str,
+        col_names: list[str],
+        unique_key: Optional[str] = None,
+    ) -> None:
+        """Add the output of a query to an existing table. With a `unique_key`, rows
+        already in the table with the same key are replaced. The new rows are staged
+        in a temporary table first, so the query runs once and outside of the
+        transaction modifying the table.
+        """
+        cols = ", ".join(col_names)
+        staging = f"{table_name}__funsql_new"
+
+        with self.connection() as conn:
+            curr = conn.cursor()
+            query_str = f"CREATE TEMP TABLE {staging} AS {query_rendered}"
+            try:
+                curr.execute(query_str)
+                conn.commit()
+            except Exception as e:
+                print(f"query err-ing:\n{query_str}\n")
+                raise e
+
+            try:
+                with self.writing():
+                    curr.execute("BEGIN")
+                    try:
+                        if unique_key is not None:
+                            curr.execute(
+                                f"DELETE FROM {table_name} WHERE {unique_key} IN "
+                                f"(SELECT {unique_key} FROM {staging})"
+                            )
+                        curr.execute(
+                            f"INSERT INTO {table_name} ({cols}) "
+                            f"SELECT {cols} FROM {staging}"
+                        )
+                        curr.execute("COMMIT")
+                    except Exception:
+                        curr.execute("ROLLBACK")
+                        raise
+            finally:
+                curr.execute(f"DROP TABLE {staging}")
+
+    def partition_key(self, column: str, grain: str) -> str:
+        """expression for the partition a row falls in, the value of a date column
+        truncated to the day, month or year as text
+        """
+        assert grain in PARTITION_GRAINS, f"unknown partition grain: {grain}"
+        return f"substr(CAST({column} AS TEXT), 1, {PARTITION_GRAINS[grain]})"
+
+    def partition_digests(
+        self, table_name: str, partition_key: str
+    ) -> dict[Optional[str], str]:
+        """Digest of the rows of a table in each partition, which changes if any row
+        in it is added, removed or updated, but not with the order of the rows.
+        """
+        with self.connection() as conn:
+            return self._partition_digests(conn.cursor(), table_name, partition_key)
+
+    def _partition_digests(
+        self, curr: Any, table_name: str, partition_key: str
+    ) -> dict[Optional[str], str]:
+        # the default reads all the rows back, and sums a hash of each
+        counts: dict[Optional[str], int] = defaultdict(int)
+        sums: dict[Optional[str], int] = defaultdict(int)
+        curr.execute(f"SELECT {partition_key}, * FROM {table_name}")
+        while True:
+            rows = curr.fetchmany(10_000)
+            if len(rows) == 0:
+                break
+            for value, *row in rows:
+                digest = hashlib.blake2b(repr(row).encode(), digest_size=8)
+                counts[value] += 1
+                sums[value] += int.from_bytes(digest.digest(), "little")
+        return {value: f"{counts[value]}:{sums[value] % 2**64:x}" for value in counts}
+
+    def build_partition(
+        self,
+        table_name: str,
+        query_rendered: str,
+        params: tuple,
+        partition_key: str,
+        value: str,
+        previous_digest: Optional[str] = None,
+    ) -> tuple[str, bool]:
+        """Run the query for one partition into a temporary table, and replace the
+        rows of the table in the partition with its output, unless their digest is
+        still `previous_digest`, see `partition_digests`.
+
+        The query runs outside of any transaction on the table, and temporary tables
+        are private to the connection, so partitions can be built concurrently.
+        Only the copy to the table is done in a (short) transaction.
+
+        Returns the digest of the rows in the partition, and whether it was written.
+        """
+        staging = f"{table_name}__funsql_part"
+        with self.connection() as conn:
+            curr = conn.cursor()
+            query_str = f"CREATE TEMP TABLE {staging} AS {query_rendered}"
+            try:
+                curr.execute(query_str, params)
+                conn.commit()
+            except Exception as e:
+                print(f"query err-ing:\n{query_str}\n")
+                raise e
+
+            try:
+                digest = self._partition_digests(curr, staging, "NULL").get(None, "0:0")
+                if digest == previous_digest:
+                    return digest, False
+                with self.writing():
+                    curr.execute("BEGIN")
+                    try:
+                        curr.execute(
+                            f"DELETE FROM {table_name} WHERE {partition_key} = ?",
+                            (value,),
+                        )
+                        curr.execute(
+                            f"INSERT INTO {table_name} SELECT * FROM {staging}"
+                        )
+                        curr.execute("COMMIT")
+                    except Exception:
+                        curr.execute("ROLLBACK")
+                        raise
+                return digest, True
+            finally:
+                curr.execute(f"DROP TABLE {staging}")
+
+    def delete_partition(self, table_name: str, partition_key: str, value: str) -> None:
+        self.execute(f"DELETE FROM {table_name} WHERE {partition_key} = ?", (value,))
+
+    def load_csv(
+        self,
+        table_name: str,
+        col_names: list[str],
+        csv_path: str,
+        column_types: Optional[dict[str, str]] = None,
+        chunk_size: int = 10_000,
+    ) -> None:
+        """(Re)create a table from the given columns of a csv file with a header row.
+        The file is streamed in chunks of rows, each inserted in its own transaction,
+        so it never needs to fit in memory. Empty values are loaded as NULL.
+        """
+        column_types = {} if column_types is None else column_types
+        col_defs = ", ".join(
+            f"{col} {column_types.get(col, self.default_column_type)}".rstrip()
+            for col in col_names
+        )
+        params = ", ".join("?" for _ in col_names)
+        insert_str = f"INSERT INTO {table_name} VALUES ({params})"
+
+        with self.connection() as conn, open(csv_path, newline="") as f, self.writing():
+            curr = conn.cursor()
+            curr.execute(f"DROP TABLE IF EXISTS {table_name}")
+            curr.execute(f"CREATE TABLE {table_name} ({col_defs})")
+            conn.commit()
+
+            reader = csv.reader(f)
+            header = next(reader)
+            missing = [col for col in col_names if col not in header]
+            assert len(missing) == 0, f"columns {missing} not found in {csv_path}"
+            indices = [header.index(col) for col in col_names]
+
+            rows = ([row[i] or None for i in indices] for row in reader)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if len(chunk) == 0:
+                    break
+                curr.executemany(insert_str, chunk)
+                conn.commit()
+
+    def table_names(self) -> set[str]:
+        """names of all the tables in the database"""
+        raise NotImplementedError
+
+    def reflect_query(self) -> str:
+        """query listing (schema, table, column) for all the tables in the database"""
+        raise NotImplementedError
+
+    def schema_version(self) -> Optional[str]:
+        """Stamp that changes whenever a table is created, dropped or altered, if the
+        database keeps one cheap to read.
+        """
+        return None
+
+    def table_columns(self, table_name: str) -> list[str]:
+        """names of the columns of an existing table"""
+        with self.connection() as conn:
+            curr = conn.cursor()
+            curr.execute(f"SELECT * FROM {table_name} LIMIT 0")
+            return [desc[0] for desc in curr.description]
+
+    def table_stats(self, table_name: str) -> dict[str, Optional[int]]:
+        """number of rows in a table, and its size on disk if the database reports it"""
+        rows = self.execute(f"SELECT count(*) FROM {table_name}")
+        return {"rows": rows[0][0], "bytes": None}
+
+    def table_version(self, table_name: str) -> str:
+        """Version stamp for the data in a table, the digest of all its rows, see
+        `partition_digests`. It changes with any row added, removed or updated, so
+        a table reloaded with the same number of rows is told apart too.
+        """
+        try:
+            digests = self.partition_digests(table_name, "NULL")
+        except Exception:
+            # CTE names etc. are not tables, and covered by the rendered SQL itself
+            return json.dumps(None)
+        return json.dumps(digests.get(None, "0:0"))
+
+
+def _row_hash(*values: Any) -> int:
+    # 32 bits, so summing the hashes of up to two billion rows fits in 64 bits
+    return zlib.crc32(repr(values).encode())
+
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class SQLiteBackend(Backend):
+    """Connections are opened in WAL mode, so readers don't block the writer, and
+    wait on a locked database for a while rather than failing right away. Renames
+    leave views alone, as otherwise a view reading a table fails the rename that
+    swaps in its new version. Pass `pragmas` to override those, or set others.
+    """
+
+    db_path: str
+    pragmas: dict[str, Any]
+    default_pragmas: dict[str, Any] = {
+        "journal_mode": "WAL",
+        "busy_timeout": 60_000,
+        "legacy_alter_table": "ON",
+    }
+    single_writer = True
+    # numeric affinity stores values that look like numbers as such, and the
+    # rest as text, close to what type inference on the csv would give
+    default_column_type = "NUMERIC"
+
+    def __init__(
+        self,
+        db_path: str,
+        pool_size: int = 1,
+        pragmas: Optional[dict[str, Any]] = None,
+    ) -> None:
+        super().__init__(pool_size)
+        self.db_path = db_path
+        self.pragmas = {**self.default_pragmas, **(pragmas or {})}
+        self.dialect = dialect_sqlite()
+
+    def connect(self) -> sqlite3.Connection:
+        # connections are handed across threads by the pool, never shared at once
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.create_function("funsql_row_hash", -1, _row_hash, deterministic=True)
+        return conn
+
+    def table_names(self) -> set[str]:
+        rows = self.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {name for name, in rows}
+
+    def reflect_query(self) -> str:
+        return reflect_sqlite()
+
+    def schema_version(self) -> Optional[str]:
+        rows = self.execute("PRAGMA schema_version")
+        return str(rows[0][0])
+
+    def _partition_digests(
+        self, curr: Any, table_name: str, partition_key: str
+    ) -> dict[Optional[str], str]:
+        # sqlite has no hash function, so rows are hashed by one registered on each
+        # connection, in chunks of columns since it only takes so many arguments
+        curr.execute(f"SELECT * FROM {table_name} LIMIT 0")
+        cols = [desc[0] for desc in curr.description]
+        chunks = [", ".join(cols[i : i + 100]) for i in range(0, len(cols), 100)]
+        row_hash = ", ".join(f"funsql_row_hash({chunk})" for chunk in chunks)
+        curr.execute(
+            f"SELECT {partition_key}, count(*), sum(funsql_row_hash({row_hash})) "
+            f"FROM {table_name} GROUP BY 1"
+        )
+        return {value: f"{count}:{digest}" for value, count, digest in curr.fetchall()}
+
+    def table_stats(self, table_name: str) -> dict[str, Optional[int]]:
+        stats = super().table_stats(table_name)
+        try:
+            # only available if sqlite was compiled with the dbstat table
+            rows = self.execute(
+                "SELECT sum(pgsize) FROM dbstat WHERE name = ?", (table_name,)
+            )
+            stats["bytes"] = rows[0][0]
+        except sqlite3.OperationalError:
+            pass
+        return stats
+
+
+class DuckDBBackend(Backend):
+    """DuckDB only lets a single process open the database file, so one connection
+    is opened up front. The pool hands out cursors over it, which can be used
+    concurrently from different threads.
+    """
+
+    db_path: str
+    settings: dict[str, Any]
+
+    def __init__(
+        self,
+        db_path: str,
+        pool_size: int = 1,
+        settings: Optional[dict[str, Any]] = None,
+    ) -> None:
+        import duckdb
+
+        super().__init__(pool_size)
+        self.db_path = db_path
+        self.settings = {} if settings is None else settings
+        self.dialect = dialect_duckdb()
+        self._root = duckdb.connect(db_path)
+
+    def connect(self) -> Any:
+        conn = self._root.cursor()
+        for name, value in self.settings.items():
+            conn.execute(f"SET {name} = '{value}'")
+        return conn
+
+    def close(self) -> None:
+        super().close()
+        self._root.close()
+
+    def load_csv(
+        self,
+        table_name: str,
+        col_names: list[str],
+        csv_path: str,
+        column_types: Optional[dict[str, str]] = None,
+        chunk_size: int = 10_000,
+    ) -> None:
+        """DuckDB's own csv reader is parallel and streaming, so it loads the file.
+        Column types not declared are detected by sampling the file.
+        """
+        path = csv_path.replace("'", "''")
+        options = ""
+        if column_types is not None and len(column_types) > 0:
+            types = ", ".join(f"'{col}': '{typ}'" for col, typ in column_types.items())
+            options = f", types = {{{types}}}"
+
+        cols = ", ".join(col_names)
+        self.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.execute(
+            f"CREATE TABLE {table_name} AS SELECT {cols} "
+            f"FROM read_csv('{path}', header = true{options})"
+        )
+
+    def table_names(self) -> set[str]:
+        rows = self.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE NOT temporary"
+        )
+        return {name for name, in rows}
+
+    def reflect_query(self) -> str:
+        return reflect_default("main")
+
+    def _partition_digests(
+        self, curr: Any, table_name: str, partition_key: str
+    ) -> dict[Optional[str], str]:
+        curr.execute(
+            f"SELECT {partition_key}, count(*), sum(hash(t)) "
+            f"FROM {table_name} AS t GROUP BY 1"
+        )
+        return {value: f"{count}:{digest}" for value, count, digest in curr.fetchall()}
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+from typing import Optional
+
+from funsql import *
+from funsql.tools import make_sql_tables
+
+from .backends import Backend
+
+
+# -----------------------------------------------------------
+# catalog of the tables in the target database, read in one
+# query and kept in sync as models are materialized
+# -----------------------------------------------------------
+
+
+class CatalogLoader:
+    """Builds the catalog from the tables in the database, with a single query
+    listing the columns of all of them.
+
+    The result is kept along with the schema version of the database, and only read
+    again once the version changes. With a `cache_path`, it is also saved to that
+    file, so a new process skips the query too. Databases that don't keep a
+    schema version are read on every load.
+
+    Tables materialized through the loader are registered in the same catalog
+    object, so code holding on to it sees them as well. Registering drops the
+    version, since other changes may have happened alongside, so the next load
+    reads the database again.
+    """
+
+    backend: Backend
+    cache_path: Optional[str]
+    catalog: SQLCatalog
+    version: Optional[str]
+
+    def __init__(self, backend: Backend, cache_path: Optional[str] = None) -> None:
+        self.backend = backend
+        self.cache_path = cache_path
+        self.catalog = SQLCatalog(dialect=backend.dialect, tables={})
+        self.version = None
+        self._lock = threading.Lock()
+
+    def load(self) -> SQLCatalog:
+        version = self.backend.schema_version()
+        with self._lock:
+            if version is not None and version == self.version:
+                return self.catalog
+
+            columns = self._read_cache(version)
+            if columns is None:
+                rows = self.backend.execute(self.backend.reflect_query())
+                # the query covers a single schema, so table names are enough
+                tables = make_sql_tables([(None, t, c) for _, t, c in rows])
+                columns = {str(t.name): [str(c) for c in t.columns] for t in tables}
+
+            self.catalog.tables.clear()
+            for table_name, col_names in columns.items():
+                self._add(table_name, col_names)
+            self.version = version
+            self._write_cache()
+        return self.catalog
+
+    def register(self, table_name: str, col_names: list[str]) -> None:
+        """add (or replace) a table created since the catalog was loaded"""
+        with self._lock:
+            self._add(table_name, col_names)
+            # the schema may have changed in ways the catalog didn't see too, so
+            # it can't be marked as current, nor saved to the cache
+            self.version = None
+
+    def _add(self, table_name: str, col_names: list[str]) -> None:
+        table = SQLTable(S(table_name), [S(col_name) for col_name in col_names])
+        self.catalog.tables[S(table_name)] = table
+
+    def _read_cache(self, version: Optional[str]) -> Optional[dict[str, list[str]]]:
+        if self.cache_path is None or version is None:
+            return None
+        if not os.path.exists(self.cache_path):
+            return None
+        with open(self.cache_path) as f:
+            data = json.load(f)
+        if data["version"] != version:
+            return None
+        return data["tables"]
+
+    def _write_cache(self) -> None:
+        if self.cache_path is None or self.version is None:
+            return
+        tables = {
+            str(name): [str(col) for col in table.columns]
+            for name, table in self.catalog
+        }
+        with open(self.cache_path, "w") as f:
+            json.dump({"version": self.version, "tables": tables}, f)
@@ -0,0 +1,268 @@
+import copyreg
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from funsql import *
+from funsql.compiler.annotate import AnnotateContext, FromTable, annotate
+from funsql.compiler.link import link_toplevel
+from funsql.compiler.resolve import resolve_toplevel
+from funsql.compiler.serialize import SerializationContext, serialize
+from funsql.compiler.translate import TranslateContext, translate_toplevel
+from funsql.common import Symbol
+from funsql.compiler.types import UnitType
+from funsql.sqlcontext import VarStyle
+
+
+# -----------------------------------------------------------
+# SQL dialects not shipped with funsql
+# -----------------------------------------------------------
+
+
+def dialect_duckdb() -> SQLDialect:
+    # postgres flavored, except for the names of the columns in a VALUES list
+    return SQLDialect(
+        name="duckdb",
+        var_style=VarStyle.NUMBERED,
+        var_prefix="$",
+        values_column_prefix="col",
+        values_column_index=0,
+    )
+
+
+# -----------------------------------------------------------
+# render queries, along with the columns they output
+# -----------------------------------------------------------
+
+
+def render_query(query: SQLNode, catalog: SQLCatalog) -> tuple[SQLString, list[str]]:
+    """Same passes as `funsql.render`, but also returns the names of the columns
+    in the output of the query, as resolved by the compiler. That saves querying
+    the database for the schema of a table created from the query.
+    """
+    ann_ctx = AnnotateContext(catalog=catalog)
+    node_annotated = annotate(query, ann_ctx)
+    resolve_toplevel(ann_ctx)
+
+    col_names = _output_columns(node_annotated)
+
+    link_toplevel(ann_ctx)
+    translate_ctx = TranslateContext(ann_ctx)
+    output_clause = translate_toplevel(node_annotated, translate_ctx)
+
+    serialize_ctx = SerializationContext(dialect=catalog.dialect)
+    serialize(output_clause, serialize_ctx)
+    return serialize_ctx.render(), col_names
+
+
+def _output_columns(node_annotated: SQLNode) -> list[str]:
+    # the type of the top level box lists the columns available at the end of the
+    # query, and the scalar ones make up its output
+    fields = node_annotated.typ.row.fields
+    return [str(name) for name, typ in fields.items() if typ == UnitType.Scalar]
+
+
+def query_columns(
+    query: SQLNode, catalog: SQLCatalog
+) -> tuple[list[str], dict[str, set[str]]]:
+    """Names of the output columns of a query, as returned by `render_query`, along
+    with the columns it reads from each table. The link pass lists the references
+    each node has to provide, so those on the nodes reading a table are the columns
+    the query uses from it. The query isn't translated to SQL, which is the bulk of
+    the work of rendering it.
+    """
+    ann_ctx = AnnotateContext(catalog=catalog)
+    node_annotated = annotate(query, ann_ctx)
+    resolve_toplevel(ann_ctx)
+    col_names = _output_columns(node_annotated)
+    link_toplevel(ann_ctx)
+
+    reads: dict[str, set[str]] = {}
+    for box in ann_ctx.boxes:
+        if not isinstance(box.over, FromTable):
+            continue
+        table = box.over.table
+        names = reads.setdefault(str(table.name), set())
+        for ref in box.refs:
+            if isinstance(ref, Get) and ref.over is None:
+                names.add(str(ref._name))
+            else:  # not expected at a table, count all its columns as used
+                names.update(str(col) for col in table.columns)
+    return col_names, reads
+
+
+# -----------------------------------------------------------
+# cache rendered queries, keyed by the structure of the query
+# -----------------------------------------------------------
+
+
+def _key_tokens(value: Any, out: list[str], sources: set[Symbol]) -> None:
+    """Spell out a query node (or any value it holds) as a flat list of tokens,
+    including the columns of the tables it reads from, unlike its repr. Names of
+    catalog tables the query reads from are collected in `sources`.
+    """
+    if isinstance(value, (SQLNode, SQLTable, SQLDialect)):
+        if isinstance(value, From) and isinstance(value.source, Symbol):
+            sources.add(value.source)
+        out.append(type(value).__name__)
+        out.append("(")
+        for k, v in vars(value).items():
+            out.append(k)
+            _key_tokens(v, out, sources)
+        out.append(")")
+    elif isinstance(value, (list, tuple)):
+        out.append("[")
+        for v in value:
+            _key_tokens(v, out, sources)
+        out.append("]")
+    elif isinstance(value, dict):
+        out.append("{")
+        for k, v in value.items():
+            _key_tokens(k, out, sources)
+            _key_tokens(v, out, sources)
+        out.append("}")
+    else:
+        out.append(type(value).__name__)
+        out.append(repr(value))
+
+
+def query_key(query: SQLNode, catalog: SQLCatalog) -> str:
+    """Hash of the structure of a query, and the parts of the catalog it depends on:
+    the dialect, and the tables the query reads by name. Much cheaper to compute
+    than rendering the query.
+    """
+    sources: set[Symbol] = set()
+    out: list[str] = []
+    _key_tokens(query, out, sources)
+    _key_tokens(catalog.dialect, out, sources)
+    for name in sorted(sources, key=str):
+        _key_tokens(catalog.tables.get(name), out, sources)
+    # repr escapes control characters, so the separator can't clash with a token
+    return hashlib.sha256("\x00".join(out).encode()).hexdigest()
+
+
+class RenderCache:
+    """Rendered queries along with their output columns, for the `maxsize` queries
+    used last. Queries built again with the same structure, say by the same model
+    over repeated runs, skip the compiler.
+
+    With a `path`, entries are also written to that directory, one json file per
+    query, and read back on a miss, so the cache outlives the process.
+    """
+
+    maxsize: int
+    path: Optional[str]
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None) -> None:
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[SQLString, list[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def render(
+        self, query: SQLNode, catalog: SQLCatalog
+    ) -> tuple[SQLString, list[str]]:
+        """same as `render_query`, served from the cache if possible"""
+        key = query_key(query, catalog)
+        entry = self.get(key)
+        if entry is None:
+            entry = render_query(query, catalog)
+            self.put(key, entry)
+        return entry
+
+    def get(self, key: str) -> Optional[tuple[SQLString, list[str]]]:
+        """entry for a key from `query_key`, from memory else from disk"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, entry)
+        return entry
+
+    def put(self, key: str, entry: tuple[SQLString, list[str]]) -> None:
+        self._write(key, entry)
+        with self._lock:
+            self._store(key, entry)
+
+    def _store(self, key: str, entry: tuple[SQLString, list[str]]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[tuple[SQLString, list[str]]]:
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, f"{key}.json")) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        variables = [S(name) for name in data["variables"]]
+        return SQLString(data["query"], variables), data["columns"]
+
+    def _write(self, key: str, entry: tuple[SQLString, list[str]]) -> None:
+        if self.path is None:
+            return
+        query_rendered, col_names = entry
+        data = {
+            "query": query_rendered.query,
+            "variables": [str(name) for name in query_rendered.variables],
+            "columns": col_names,
+        }
+        # written aside and moved in place, so readers never see a partial file
+        file_path = os.path.join(self.path, f"{key}.json")
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, file_path)
+
+
+# -----------------------------------------------------------
+# pickle support for queries, to render them in other processes
+# -----------------------------------------------------------
+
+
+def _rebuild_node(kls: type, attrs: dict[str, Any]) -> SQLNode:
+    node = object.__new__(kls)
+    node.__dict__.update(attrs)
+    return node
+
+
+def _reduce_node(node: SQLNode) -> tuple:
+    # nodes like `Get` resolve unknown attributes to new nodes, so the lookup of
+    # `__reduce_ex__` pickle does by default goes wrong. Registered reducers are
+    # used without looking anything up on the object.
+    return _rebuild_node, (type(node), vars(node))
+
+
+def _subclasses(kls: type) -> list[type]:
+    found = []
+    for sub in kls.__subclasses__():
+        found.append(sub)
+        found.extend(_subclasses(sub))
+    return found
+
+
+# symbols are interned, unpickling one looks up the existing copy
+copyreg.pickle(Symbol, lambda symbol: (Symbol, (symbol.data,)))
+for _kls in _subclasses(SQLNode):
+    copyreg.pickle(_kls, _reduce_node)
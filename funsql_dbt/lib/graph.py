@@ -0,0 +1,83 @@
+from collections import defaultdict, deque
+from typing import Callable, Hashable, Iterable, TypeVar
+
+
+# -----------------------------------------------------------
+# DAG utilities, over any nodes that can list their parents
+# -----------------------------------------------------------
+
+
+Node = TypeVar("Node", bound=Hashable)
+
+
+class CycleError(Exception):
+    pass
+
+
+def build_graph(
+    targets: Iterable[Node], parents_of: Callable[[Node], Iterable[Node]]
+) -> tuple[dict[Node, list[Node]], dict[Node, int]]:
+    """Walk up from the target nodes, and collect the children and the count of
+    parents for each node in the DAG. Each node is visited once, and a parent listed
+    more than once by a node adds a single edge. Raises a `CycleError` naming the
+    nodes involved if the graph has a cycle.
+    """
+    node_children: dict[Node, list[Node]] = defaultdict(list)
+    node_parent_count: dict[Node, int] = {}
+
+    queue: deque[Node] = deque()
+    for node in targets:
+        if node not in node_parent_count:
+            node_parent_count[node] = 0
+            queue.append(node)
+
+    while len(queue) > 0:
+        node = queue.popleft()
+        for parent in dict.fromkeys(parents_of(node)):
+            node_children[parent].append(node)
+            node_parent_count[node] += 1
+            if parent not in node_parent_count:
+                node_parent_count[parent] = 0
+                queue.append(parent)
+
+    order = topological_order(node_children, node_parent_count)
+    if len(order) < len(node_parent_count):
+        remaining = set(node_parent_count).difference(order)
+        cycle = find_cycle(remaining, parents_of)
+        names = " -> ".join(getattr(node, "__name__", str(node)) for node in cycle)
+        raise CycleError(f"models depend on each other in a cycle: {names}")
+    return node_children, node_parent_count
+
+
+def topological_order(
+    node_children: dict[Node, list[Node]], node_parent_count: dict[Node, int]
+) -> list[Node]:
+    """nodes ordered parents first, leaving out the ones stuck in a cycle"""
+    order = []
+    parent_count = dict(node_parent_count)
+    queue = deque(node for node, count in parent_count.items() if count == 0)
+    while len(queue) > 0:
+        node = queue.popleft()
+        order.append(node)
+        for child in node_children.get(node, []):
+            parent_count[child] -= 1
+            if parent_count[child] == 0:
+                queue.append(child)
+    return order
+
+
+def find_cycle(
+    remaining: set[Node], parents_of: Callable[[Node], Iterable[Node]]
+) -> list[Node]:
+    """A cycle among the nodes left over by a topological sort. Each of them has a
+    parent left over too, so following those from any node has to come back around.
+    The cycle is listed from a child to its parent, ending at the node it began at.
+    """
+    path: list[Node] = []
+    position: dict[Node, int] = {}
+    node = next(iter(remaining))
+    while node not in position:
+        position[node] = len(path)
+        path.append(node)
+        node = next(p for p in parents_of(node) if p in remaining)
+    return path[position[node] :] + [node]
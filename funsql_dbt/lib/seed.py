@@ -0,0 +1,43 @@
+import os
+from typing import Optional
+
+from funsql import *
+
+from .backends import Backend
+
+
+# -----------------------------------------------------------
+# load the raw tables in the catalog from csv files
+# -----------------------------------------------------------
+
+
+def seed_tables(
+    backend: Backend,
+    catalog: SQLCatalog,
+    seed_dir: str,
+    column_types: Optional[dict[str, dict[str, str]]] = None,
+    chunk_size: int = 10_000,
+) -> list[str]:
+    """Load each table in the catalog that has a `<table name>.csv` file in the
+    seed directory, with the columns listed for the table in the catalog. Column
+    types can be declared per table, else the backend decides them.
+
+    Returns the names of the tables loaded.
+    """
+    column_types = {} if column_types is None else column_types
+
+    seeded = []
+    for name, table in catalog:
+        csv_path = os.path.join(seed_dir, f"{name}.csv")
+        if not os.path.exists(csv_path):
+            continue
+
+        backend.load_csv(
+            str(name),
+            [str(col) for col in table.columns],
+            csv_path,
+            column_types.get(str(name)),
+            chunk_size,
+        )
+        seeded.append(str(name))
+    return seeded
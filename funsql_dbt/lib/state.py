@@ -0,0 +1,285 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from funsql import *
+
+from .backends import Backend
+
+
+# -----------------------------------------------------------
+# build state persisted in the target database, so models that
+# haven't changed since the last run can be skipped
+# -----------------------------------------------------------
+
+
+STATE_TABLE = "_funsql_dbt_state"
+
+
+def source_tables(query: SQLNode) -> set[str]:
+    """names of all the tables a query reads from, walking the full node tree"""
+    names: set[str] = set()
+    stack: list[SQLNode] = [query]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, From):
+            if isinstance(node.source, SQLTable):
+                names.add(str(node.source.name))
+            elif isinstance(node.source, Symbol):
+                names.add(str(node.source))
+
+        for value in vars(node).values():
+            if isinstance(value, SQLNode):
+                stack.append(value)
+            elif isinstance(value, (list, tuple)):
+                stack.extend(v for v in value if isinstance(v, SQLNode))
+    return names
+
+
+class BuildState:
+    """Fingerprints of the models materialized in earlier runs, along with the
+    columns of the table they produced.
+
+    A fingerprint hashes the rendered SQL of the model, which captures all the
+    context values that went into constructing the query, along with the
+    fingerprints of the materialized models and the versions of the source tables
+    it reads from. If it matches the one recorded for an existing table, the model
+    doesn't need to be rebuilt.
+
+    The version of the table itself is recorded too, see `Backend.table_version`,
+    so a table written since, by a run without the build state or anything else,
+    is rebuilt even when the fingerprint matches.
+    """
+
+    backend: Backend
+    previous: dict[str, tuple[str, list[str], str]]
+    current: dict[str, str]
+    source_versions: dict[str, str]
+
+    def __init__(self, backend: Backend) -> None:
+        self.backend = backend
+        self.previous = {}
+        self.current = {}
+        self.source_versions = {}
+
+    def load(self) -> "BuildState":
+        tables = self.backend.table_names()
+        if STATE_TABLE in tables:
+            # entries recorded without the table version can't be trusted
+            if "version" not in self.backend.table_columns(STATE_TABLE):
+                self.backend.execute(f"DROP TABLE {STATE_TABLE}")
+        self.backend.execute(
+            f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} "
+            "(model TEXT PRIMARY KEY, fingerprint TEXT, columns TEXT, version TEXT)"
+        )
+        rows = self.backend.execute(
+            f"SELECT model, fingerprint, columns, version FROM {STATE_TABLE}"
+        )
+
+        # only keep entries for tables that still exist in the database
+        self.previous = {
+            model: (fingerprint, json.loads(columns), version)
+            for model, fingerprint, columns, version in rows
+            if model in tables
+        }
+        return self
+
+    def source_version(self, table_name: str) -> str:
+        if table_name not in self.source_versions:
+            version = self.backend.table_version(table_name)
+            self.source_versions[table_name] = version
+        return self.source_versions[table_name]
+
+    def fingerprint(self, query: SQLNode, query_rendered: SQLString) -> str:
+        deps = []
+        for name in sorted(source_tables(query)):
+            if name in self.current:
+                deps.append((name, self.current[name]))
+            else:
+                deps.append((name, self.source_version(name)))
+
+        payload = json.dumps(
+            [query_rendered.query, [str(v) for v in query_rendered.variables], deps]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def unchanged(self, model: str, fingerprint: str) -> bool:
+        """whether the existing table for the model is up to date"""
+        self.current[model] = fingerprint
+        entry = self.previous.get(model)
+        if entry is None or entry[0] != fingerprint:
+            return False
+        # the table may have been written since it was built
+        if self.backend.table_columns(model) != entry[1]:
+            return False
+        return self.backend.table_version(model) == entry[2]
+
+    def record(self, model: str, fingerprint: str, col_names: list[str]) -> None:
+        version = self.backend.table_version(model)
+        self.backend.execute(
+            f"INSERT OR REPLACE INTO {STATE_TABLE} VALUES (?, ?, ?, ?)",
+            (model, fingerprint, json.dumps(col_names), version),
+        )
+
+
+# -----------------------------------------------------------
+# log of the models completed in each run, so a failed run
+# can be resumed from where it stopped
+# -----------------------------------------------------------
+
+
+RUNS_TABLE = "_funsql_dbt_runs"
+RUN_MODELS_TABLE = "_funsql_dbt_run_models"
+
+
+class RunLog:
+    """Records each run, and every materialized model as soon as its table is
+    built, along with the columns of the table.
+
+    Resuming picks up the latest run if it didn't succeed, keeping its run id. The
+    models it completed, whose tables still exist, are not built again.
+    """
+
+    backend: Backend
+    run_id: str
+    completed: dict[str, list[str]]
+
+    def __init__(self, backend: Backend) -> None:
+        self.backend = backend
+        self.run_id = ""
+        self.completed = {}
+
+    def start(self, resume: bool = False) -> "RunLog":
+        self.backend.execute(
+            f"CREATE TABLE IF NOT EXISTS {RUNS_TABLE} "
+            "(run_id TEXT PRIMARY KEY, started_at TEXT, status TEXT, error TEXT)"
+        )
+        self.backend.execute(
+            f"CREATE TABLE IF NOT EXISTS {RUN_MODELS_TABLE} "
+            "(run_id TEXT, model TEXT, columns TEXT, PRIMARY KEY (run_id, model))"
+        )
+
+        rows = []
+        if resume:
+            rows = self.backend.execute(
+                f"SELECT run_id, status FROM {RUNS_TABLE} "
+                "ORDER BY started_at DESC LIMIT 1"
+            )
+        if len(rows) > 0 and rows[0][1] != "success":
+            self.run_id = rows[0][0]
+            models = self.backend.execute(
+                f"SELECT model, columns FROM {RUN_MODELS_TABLE} WHERE run_id = ?",
+                (self.run_id,),
+            )
+            tables = self.backend.table_names()
+            self.completed = {
+                model: json.loads(columns)
+                for model, columns in models
+                if model in tables
+            }
+            self.backend.execute(
+                f"UPDATE {RUNS_TABLE} SET status = 'running' WHERE run_id = ?",
+                (self.run_id,),
+            )
+        else:
+            self.run_id = uuid.uuid4().hex
+            self.backend.execute(
+                f"INSERT INTO {RUNS_TABLE} VALUES (?, ?, 'running', NULL)",
+                (self.run_id, datetime.now(timezone.utc).isoformat()),
+            )
+        return self
+
+    def record(self, model: str, col_names: list[str]) -> None:
+        self.backend.execute(
+            f"INSERT OR REPLACE INTO {RUN_MODELS_TABLE} VALUES (?, ?, ?)",
+            (self.run_id, model, json.dumps(col_names)),
+        )
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        status = "success" if error is None else "error"
+        self.backend.execute(
+            f"UPDATE {RUNS_TABLE} SET status = ?, error = ? WHERE run_id = ?",
+            (status, None if error is None else repr(error), self.run_id),
+        )
+
+
+# -----------------------------------------------------------
+# fingerprints of each partition of a partitioned model, so
+# only the partitions whose inputs or rows changed are rebuilt
+# -----------------------------------------------------------
+
+
+PARTITIONS_TABLE = "_funsql_dbt_partitions"
+
+
+class PartitionState:
+    """The partitions of a model built in earlier runs, each with two fingerprints.
+
+    The inputs hash the rendered SQL of the model along with the partition and the
+    versions of the tables it reads from, see `Backend.table_version`. A partition
+    whose inputs didn't change doesn't need to be computed again. The digest is of
+    the rows the query output in the partition, see `Backend.partition_digests`,
+    so a partition computed again is only written if any of its rows changed.
+
+    Each partition is recorded as soon as it is built, so a failed build picks up
+    where it stopped.
+    """
+
+    backend: Backend
+    model: str
+    previous: dict[str, tuple[str, str]]
+
+    def __init__(self, backend: Backend, model: str) -> None:
+        self.backend = backend
+        self.model = model
+        self.previous = {}
+
+    def load(self) -> "PartitionState":
+        if PARTITIONS_TABLE in self.backend.table_names():
+            # recorded without the inputs of each partition, start over
+            if "inputs" not in self.backend.table_columns(PARTITIONS_TABLE):
+                self.backend.execute(f"DROP TABLE {PARTITIONS_TABLE}")
+        self.backend.execute(
+            f"CREATE TABLE IF NOT EXISTS {PARTITIONS_TABLE} "
+            "(model TEXT, partition_value TEXT, inputs TEXT, digest TEXT, "
+            "PRIMARY KEY (model, partition_value))"
+        )
+        rows = self.backend.execute(
+            f"SELECT partition_value, inputs, digest FROM {PARTITIONS_TABLE} "
+            "WHERE model = ?",
+            (self.model,),
+        )
+        self.previous = {value: (inputs, digest) for value, inputs, digest in rows}
+        return self
+
+    @staticmethod
+    def inputs(query_rendered: SQLString, value: str, versions: dict[str, str]) -> str:
+        payload = json.dumps(
+            [
+                query_rendered.query,
+                [str(v) for v in query_rendered.variables],
+                value,
+                sorted(versions.items()),
+            ]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def record(self, value: str, inputs: str, digest: str) -> None:
+        self.backend.execute(
+            f"INSERT OR REPLACE INTO {PARTITIONS_TABLE} VALUES (?, ?, ?, ?)",
+            (self.model, value, inputs, digest),
+        )
+
+    def forget(self, value: str) -> None:
+        self.backend.execute(
+            f"DELETE FROM {PARTITIONS_TABLE} WHERE model = ? AND partition_value = ?",
+            (self.model, value),
+        )
+
+    def forget_all(self) -> None:
+        self.backend.execute(
+            f"DELETE FROM {PARTITIONS_TABLE} WHERE model = ?", (self.model,)
+        )
+        self.previous = {}
@@ -1,8 +1,28 @@
-import sqlite3
-from collections import defaultdict
-from typing import Any, Optional, ClassVar, Type
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Optional, ClassVar, Type
 
 from funsql import *
+from tabulate import tabulate
+
+from .backends import PARTITION_GRAINS, Backend, SQLiteBackend
+from .compiler import query_columns, query_key, render_query
+from .graph import build_graph, topological_order
+from .state import BuildState, PartitionState, RunLog, source_tables
 
 
 # -----------------------------------------------------------
@@ -12,22 +32,58 @@ from funsql import *
 
 Context = dict[str, Any]
 
+# queries of the non-materialized models used by the model being compiled, when
+# they are to be hoisted into a WITH clause
+_cte_scope: ContextVar[Optional[dict[str, SQLNode]]] = ContextVar(
+    "_cte_scope", default=None
+)
+
+
+def get_parent_models(kls) -> tuple[tuple[str, Type["DataModel"]], ...]:
+    return kls.__parents__
+
 
-def get_parent_models(kls) -> list[tuple[str, Type["DataModel"]]]:
-    return [
-        (field, typ)
-        for field, typ in kls.__annotations__.items()
-        if isinstance(typ, type) and issubclass(typ, DataModel)
-    ]
+def _parent_nodes(kls) -> tuple[Type["DataModel"], ...]:
+    return kls.__parent_models__
 
 
 class DataModel:
     __materialize__: ClassVar[bool] = False
+    __cost__: ClassVar[float] = 1.0  # relative runtime hint, for scheduling
+    __strategy__: ClassVar[str] = "replace"  # or "swap", see `Backend.create_table`
+
+    # Incremental models set the strategy to "append" or "merge". Once the table
+    # exists, the query receives the max value of the `__watermark__` column in
+    # `ctx["last_watermark"]`, and should only produce the rows past it. Those
+    # are appended to the table, or replace rows with the same `__unique_key__`.
+    __watermark__: ClassVar[Optional[str]] = None
+    __unique_key__: ClassVar[Optional[str]] = None
+
+    # Partitioned models set the strategy to "partition". The table is split by the
+    # `__partition_by__` date column, truncated to the `__partition_grain__`, and
+    # built a partition at a time, see `_build_partitions`. The partitions are
+    # listed by `partitions`, and the query can use `in_partition` to only read
+    # the source rows of the one being built.
+    __partition_by__: ClassVar[Optional[str]] = None
+    __partition_grain__: ClassVar[str] = "day"  # or "month", "year"
+
+    # The models a model depends on, read from the annotations once, as each class
+    # is defined. Children are only collected per run, for the models being built.
+    __parents__: ClassVar[tuple[tuple[str, Type["DataModel"]], ...]] = ()
+    __parent_models__: ClassVar[tuple[Type["DataModel"], ...]] = ()
     materialized: Optional[SQLNode]
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.__parents__ = tuple(
+            (field, typ)
+            for field, typ in cls.__dict__.get("__annotations__", {}).items()
+            if isinstance(typ, type) and issubclass(typ, DataModel)
+        )
+        cls.__parent_models__ = tuple(parent for _, parent in cls.__parents__)
+
     def __init__(self, *args) -> None:
-        fields = [f for f, _ in get_parent_models(self.__class__)]
-        for field, arg in zip(fields, args):
+        for (field, _), arg in zip(self.__parents__, args):
             setattr(self, field, arg)
         self.materialized = None
 
@@ -36,14 +92,47 @@ class DataModel:
         return cls.__materialize__
 
     def __call__(self, ctx: Context) -> SQLNode:
-        if self.__materialize__ is False or self.materialized is None:
-            return self.query(ctx)
-        else:
+        if self.materialized is not None:
             return self.materialized
 
+        ctes = _cte_scope.get()
+        if ctes is None:
+            return self.query(ctx)
+
+        # compiling with shared CTEs, so only a reference to this model is returned.
+        # Parents register themselves while the query is built, so they come first.
+        name = self.__class__.__name__
+        if name not in ctes:
+            query = self.query(ctx)
+            ctes[name] = query
+        return From(S(name))
+
     def query(self, ctx: Context) -> SQLNode:
         raise Exception("Not implemented")
 
+    def partitions(self, ctx: Context) -> SQLNode:
+        """Query whose `__partition_by__` column holds the dates of all the
+        partitions of a partitioned model. Defaults to the full query of the model,
+        so it is worth overriding with one reading only the source of the dates.
+        """
+        return self.query(ctx)
+
+
+def in_partition(query: SQLNode, ctx: Context, column: str) -> SQLNode:
+    """Keep the rows of the query in the partition being built, by the value of
+    a date column. Outside of partitioned builds the query is left as is.
+    """
+    grain = ctx.get("partition_grain")
+    if grain is None:
+        return query
+    return query >> Where(Fun("=", _partition_key(column, grain), Var.partition))
+
+
+def _partition_key(column: str, grain: str) -> SQLNode:
+    # the same as `Backend.partition_key`, for the queries of the models
+    assert grain in PARTITION_GRAINS, f"unknown partition grain: {grain}"
+    return Fun.substr(Fun.cast(Get(column), "TEXT"), 1, PARTITION_GRAINS[grain])
+
 
 # -----------------------------------------------------------
 # Set up a prefect flow to materialize all the data models
@@ -62,77 +151,996 @@ def fill_graph(model: Type[DataModel], node_children: dict, node_parent_count: d
         fill_graph(parent, node_children, node_parent_count)
 
 
-def db_create_table(table_name: str, query_rendered: str, ctx: Context) -> list[str]:
-    conn = sqlite3.connect(ctx["db_path"])
+def db_create_table(
+    table_name: str, query_rendered: str, ctx: Context, strategy: str = "replace"
+) -> None:
+    backend: Backend = ctx["backend"]
+    backend.create_table(table_name, query_rendered, strategy)
+
+
+def get_backend(ctx: Context, pool_size: int = 1) -> tuple[Backend, bool]:
+    """backend from the context if one was passed in, else a new sqlite backend for
+    `ctx["db_path"]`. Also returns whether the backend was created here, so the
+    caller knows to close it.
+    """
+    if "backend" in ctx:
+        return ctx["backend"], False
+    return SQLiteBackend(ctx["db_path"], pool_size=pool_size), True
+
+
+async def db_create_table_async(
+    table_name: str, query_rendered: str, ctx: Context, strategy: str = "replace"
+) -> None:
+    """sqlite doesn't have an async driver, so the blocking call is run in a worker
+    thread to keep the event loop free.
+    """
+    await asyncio.to_thread(db_create_table, table_name, query_rendered, ctx, strategy)
 
-    with conn:
-        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
 
-    query_str = f"CREATE TABLE {table_name} AS {query_rendered}"
+def _build_graph(
+    models: list[Type[DataModel]],
+) -> tuple[dict[Type[DataModel], list[Type[DataModel]]], dict[Type[DataModel], int]]:
+    """Walk up from the given models, and collect the children and the count of
+    parents for each model in the DAG, see `graph.build_graph`.
+    """
+    return build_graph(models, _parent_nodes)
+
+
+def _compile_with_ctes(node_instance: DataModel, ctx: Context) -> SQLNode:
+    """Build the query for a model, with each non-materialized model it uses
+    compiled once in a WITH clause instead of being inlined wherever it is called.
+    """
+    token = _cte_scope.set({})
     try:
-        with conn:
-            conn.execute(query_str)
-    except sqlite3.OperationalError as e:
-        print(f"query err-ing:\n{query_str}\n")
-        raise e
+        query = node_instance.query(ctx)
+        ctes = _cte_scope.get()
+    finally:
+        _cte_scope.reset(token)
+
+    # the innermost WITH can see the ones wrapping it, so dependencies go outside
+    for name, cte in reversed(ctes.items()):
+        query = query >> With(cte >> As(S(name)))
+    return query
+
+
+def _build_query(
+    node: Type[DataModel],
+    results: dict[Type[DataModel], DataModel],
+    ctx: Context,
+    persist: bool,
+) -> tuple[DataModel, SQLNode]:
+    """Instantiate the model with its (already executed) parents, and build its
+    query.
+
+    Non-materialized parents are inlined as subqueries by default. Setting
+    `ctx["ephemeral"] = "cte"` hoists them into a single WITH clause instead.
+    """
+    parents = [results[p] for p in _parent_nodes(node)]
+    node_instance = node(*parents)
+
+    if persist and ctx.get("ephemeral", "inline") == "cte":
+        return node_instance, _compile_with_ctes(node_instance, ctx)
+    return node_instance, node_instance(ctx)
+
+
+def _compile_model(
+    node: Type[DataModel],
+    results: dict[Type[DataModel], DataModel],
+    ctx: Context,
+    persist: bool,
+) -> tuple[DataModel, SQLNode, Optional[SQLString], list[str]]:
+    """Build the query of a model, see `_build_query`, and render it along with
+    the names of its output columns, if the model is to be materialized. Queries are
+    rendered through `ctx["render_cache"]` if one is passed, see
+    `compiler.RenderCache`. Only the columns listed for the model in
+    `ctx["keep_columns"]` are kept, if any. While building the partitions of a
+    model, only the rows in the partition are kept, see `in_partition`.
+    """
+    node_instance, query = _build_query(node, results, ctx, persist)
+    if persist and node.__strategy__ == "partition":
+        column = node.__partition_by__
+        assert column is not None, f"no partition column for {node.__name__}"
+        query = in_partition(query, ctx, column)
+    keep = ctx.get("keep_columns", {}).get(node.__name__)
+    if persist and keep is not None:
+        query = query >> Select(*[Get(col_name) for col_name in keep])
+    if persist:
+        render = ctx["render_cache"].render if "render_cache" in ctx else render_query
+        query_rendered, col_names = render(query, ctx["catalog"])
+        return node_instance, query, query_rendered, col_names
+    return node_instance, query, None, []
+
+
+def _attach_table(node_instance: DataModel, col_names: list[str]) -> None:
+    table_name = node_instance.__class__.__name__
+    table = SQLTable(S(table_name), [S(col_name) for col_name in col_names])
+    # wrapped in a From node, since the children query uses it directly
+    node_instance.materialized = From(table)
+
+
+def _last_watermark(node: Type[DataModel], ctx: Context) -> Any:
+    """max value of the watermark column in the existing table of an incremental
+    model, or None if the table needs to be built from scratch
+    """
+    assert node.__watermark__ is not None, f"no watermark column for {node.__name__}"
+    if node.__strategy__ == "merge":
+        assert node.__unique_key__ is not None, f"no unique key for {node.__name__}"
 
-    curr = conn.cursor()
-    curr.execute(f"SELECT * FROM {table_name} LIMIT 0")
-    col_names: list[str] = [desc[0] for desc in curr.description]
-    conn.close()
+    backend: Backend = ctx["backend"]
+    if node.__name__ not in backend.table_names():
+        return None
+    rows = backend.execute(f"SELECT max({node.__watermark__}) FROM {node.__name__}")
+    return rows[0][0]
+
+
+def _build_partitions(
+    node: Type[DataModel],
+    node_instance: DataModel,
+    query: SQLNode,
+    query_rendered: SQLString,
+    col_names: list[str],
+    ctx: Context,
+) -> tuple[int, int]:
+    """Build the table of a partitioned model a partition at a time.
+
+    The query is rendered once, with the partition as a variable, and runs for
+    each partition into a temporary table, over a pool of threads as large as the
+    backend's, see `Backend.build_partition`. Only the partitions whose rows
+    changed are written to the table, each in its own short transaction. Those
+    whose SQL and source tables didn't change since they were last built are not
+    computed at all, so a failed build resumes with the partitions it didn't get
+    to. Partitions no longer listed by the model are deleted.
+
+    If the table doesn't exist yet, or its columns changed, it is created empty,
+    and all the partitions are built.
+
+    Returns the number of partitions, and how many of them were written.
+    """
+    backend: Backend = ctx["backend"]
+    table_name = node.__name__
+    key = backend.partition_key(node.__partition_by__, node.__partition_grain__)
+    partitions = PartitionState(backend, table_name).load()
 
-    return col_names
+    # the dates the partitions are read from aren't filtered to a partition
+    listing = node_instance.partitions({**ctx, "partition_grain": None}) >> Group(
+        aka(_partition_key(node.__partition_by__, node.__partition_grain__), "value")
+    )
+    listing_rendered, _ = render_query(listing >> Select(Get.value), ctx["catalog"])
+    values = [value for value, in backend.execute(listing_rendered.query)]
+    assert None not in values, f"{table_name}: NULL values in {node.__partition_by__}"
+    values.sort()
 
+    def params(value: str) -> tuple:
+        return tuple(value for _ in query_rendered.variables)
+
+    exists = table_name in backend.table_names()
+    if (
+        not exists
+        or len(partitions.previous) == 0
+        or backend.table_columns(table_name) != col_names
+    ):
+        partitions.forget_all()
+        empty = f"SELECT * FROM ({query_rendered.query}) AS q LIMIT 0"
+        backend.create_table(table_name, empty, params=params(""))
+
+    versions = {name: backend.table_version(name) for name in source_tables(query)}
+
+    def build(value: str) -> bool:
+        inputs = partitions.inputs(query_rendered, value, versions)
+        previous = partitions.previous.get(value)
+        if previous is not None and previous[0] == inputs:
+            return False
+        digest, written = backend.build_partition(
+            table_name,
+            query_rendered.query,
+            params(value),
+            key,
+            value,
+            None if previous is None else previous[1],
+        )
+        partitions.record(value, inputs, digest)
+        return written
+
+    with ThreadPoolExecutor(max_workers=backend.pool_size) as pool:
+        futures = [pool.submit(build, value) for value in values]
+        num_written = sum(fut.result() for fut in futures)
+    for value in set(partitions.previous) - set(values):
+        backend.delete_partition(table_name, key, value)
+        partitions.forget(value)
+    return len(values), num_written
+
+
+def _execute_model(
+    node: Type[DataModel],
+    results: dict[Type[DataModel], DataModel],
+    ctx: Context,
+    persist: bool,
+    state: Optional[BuildState] = None,
+    metrics: Optional[dict[str, Any]] = None,
+    reuse: Optional[tuple[str, Optional[list[str]]]] = None,
+) -> DataModel:
+    """Execute a single model, materializing it in the database if specified. With
+    a build state, the table is left as is when the model's fingerprint matches the
+    one recorded in an earlier run.
+
+    With `reuse`, a (status, columns) pair, the model isn't compiled at all, and
+    the table it built in an earlier run is used as is. Its columns are read from
+    the database if not known.
+
+    If a `metrics` dict is passed, the time spent rendering and executing the
+    query, and the stats of the table created are recorded in it.
+    """
+    metrics = {} if metrics is None else metrics
+    table_name = node.__name__
+    if reuse is not None:
+        status, col_names = reuse
+        if col_names is None:
+            col_names = ctx["backend"].table_columns(table_name)
+        node_instance = node()  # parents are not needed to read the table
+        _attach_table(node_instance, col_names)
+        metrics["status"] = status
+        return node_instance
+
+    incremental = persist and node.__strategy__ in ("append", "merge")
+    if incremental:
+        ctx = {**ctx, "last_watermark": _last_watermark(node, ctx)}
+    partitioned = persist and node.__strategy__ == "partition"
+    if partitioned:
+        ctx = {**ctx, "partition_grain": node.__partition_grain__}
+
+    start = time.perf_counter()
+    node_instance, query, query_rendered, col_names = _compile_model(
+        node, results, ctx, persist
+    )
+    metrics["render_time"] = time.perf_counter() - start
+    if query_rendered is None:
+        metrics["status"] = "ephemeral"
+        return node_instance
+
+    if state is not None:
+        fingerprint = state.fingerprint(query, query_rendered)
+        if state.unchanged(table_name, fingerprint):
+            _attach_table(node_instance, col_names)
+            metrics["status"] = "skipped"
+            return node_instance
+
+    start = time.perf_counter()
+    if incremental and ctx["last_watermark"] is not None:
+        backend: Backend = ctx["backend"]
+        unique_key = node.__unique_key__ if node.__strategy__ == "merge" else None
+        backend.insert_rows(table_name, query_rendered.query, col_names, unique_key)
+    elif partitioned:
+        num_partitions, num_written = _build_partitions(
+            node, node_instance, query, query_rendered, col_names, ctx
+        )
+        metrics["partitions"] = f"{num_written}/{num_partitions}"
+    else:
+        strategy = "replace" if incremental else node.__strategy__
+        db_create_table(table_name, query_rendered.query, ctx, strategy)
+    metrics["execution_time"] = time.perf_counter() - start
+    metrics["status"] = "built"
+
+    if state is not None:
+        state.record(table_name, fingerprint, col_names)
+    if "rows" in metrics:  # only when the table stats were asked for
+        metrics.update(ctx["backend"].table_stats(table_name))
+    if "catalog_loader" in ctx:
+        ctx["catalog_loader"].register(table_name, col_names)
+    _attach_table(node_instance, col_names)
+    return node_instance
+
+
+def _topological_order(
+    node_children: dict[Type[DataModel], list[Type[DataModel]]],
+    node_parent_count: dict[Type[DataModel], int],
+) -> list[Type[DataModel]]:
+    return topological_order(node_children, node_parent_count)
+
+
+def _model_cost(node: Type[DataModel], durations: dict[str, float], persist: bool):
+    """runtime from an earlier run if recorded, else the static hint on the class.
+    Models that are not materialized only build a query, so cost nothing.
+    """
+    if node.__name__ in durations:
+        return durations[node.__name__]
+    return node.__cost__ if persist else 0.0
+
+
+def _critical_paths(
+    node_children: dict[Type[DataModel], list[Type[DataModel]]],
+    node_parent_count: dict[Type[DataModel], int],
+    durations: dict[str, float],
+    plan: dict[Type[DataModel], bool],
+) -> dict[Type[DataModel], float]:
+    """For each model, the cost of the longest chain of models starting at it and
+    going down to a leaf of the DAG.
+    """
+    paths: dict[Type[DataModel], float] = {}
+    for node in reversed(_topological_order(node_children, node_parent_count)):
+        downstream = [paths[child] for child in node_children[node]]
+        cost = _model_cost(node, durations, plan[node])
+        paths[node] = cost + max(downstream, default=0.0)
+    return paths
+
+
+# -----------------------------------------------------------
+# select a subgraph of the models to build
+# -----------------------------------------------------------
+
+
+def _reachable(
+    edges: Callable[[Type[DataModel]], Iterable[Type[DataModel]]],
+    start: set[Type[DataModel]],
+) -> set[Type[DataModel]]:
+    nodes = set(start)
+    stack = list(start)
+    while len(stack) > 0:
+        for other in edges(stack.pop()):
+            if other not in nodes:
+                nodes.add(other)
+                stack.append(other)
+    return nodes
+
+
+def select_models(
+    node_children: dict[Type[DataModel], list[Type[DataModel]]],
+    node_parent_count: dict[Type[DataModel], int],
+    selectors: list[str],
+) -> set[Type[DataModel]]:
+    """Models in the graph matched by dbt style selectors, by model name.
+
+    `name` selects the model alone, `+name` adds its ancestors, and `name+` its
+    descendants. `@name` selects the model, its descendants, and all the ancestors
+    of those. Descendants are looked up in the graph built from the target models.
+    """
+    by_name = {node.__name__: node for node in node_parent_count}
+    children = node_children.__getitem__
+
+    selected: set[Type[DataModel]] = set()
+    for selector in selectors:
+        name = selector.strip("@+")
+        assert name in by_name, f"selector {selector}: no model {name} in the graph"
+        nodes = {by_name[name]}
+        if selector.startswith("@"):
+            nodes = _reachable(_parent_nodes, _reachable(children, nodes))
+        else:
+            if selector.endswith("+"):
+                nodes |= _reachable(children, nodes)
+            if selector.startswith("+"):
+                nodes |= _reachable(_parent_nodes, {by_name[name]})
+        selected |= nodes
+    return selected
+
+
+def _restrict_graph(
+    node_parent_count: dict[Type[DataModel], int],
+    selected: set[Type[DataModel]],
+    reused: set[Type[DataModel]],
+) -> tuple[dict[Type[DataModel], list[Type[DataModel]]], dict[Type[DataModel], int]]:
+    """Cut the graph down to the selected models, and the ancestors they need.
+    The existing tables of reused models are read instead of building them, so
+    their own ancestors are only kept if needed by another model.
+    """
+    # in the order of the full graph, rather than that of the set
+    targets = [node for node in node_parent_count if node in selected]
+    return build_graph(
+        targets, lambda node: [] if node in reused else _parent_nodes(node)
+    )
+
+
+# -----------------------------------------------------------
+# plan which of the intermediate models to materialize
+# -----------------------------------------------------------
+
+
+def plan_materialization(
+    models: list[Type[DataModel]],
+    durations: Optional[dict[str, float]] = None,
+    min_consumers: int = 2,
+    min_cost: float = 0.0,
+) -> tuple[dict[Type[DataModel], bool], list[list]]:
+    """Decide which models in the DAG to materialize.
+
+    A model that isn't materialized gets inlined into the query of every
+    materialized model downstream of it, and is computed again for each of them.
+    Going from the leaves of the DAG up, an intermediate model is materialized if it
+    would be inlined into at least `min_consumers` tables, and its estimated cost
+    (from `durations` recorded in an earlier run, else the `__cost__` hint) is at
+    least `min_cost`. The target models, and models declared with
+    `__materialize__ = True`, keep their setting.
+
+    Returns the plan, and a row per model describing the decision.
+    """
+    node_children, node_parent_count = _build_graph(models)
+    if durations is None:
+        durations = {}
+
+    plan: dict[Type[DataModel], bool] = {}
+    consumers: dict[Type[DataModel], set[Type[DataModel]]] = {}
+    rows = []
+    for node in reversed(_topological_order(node_children, node_parent_count)):
+        consumers[node] = set()
+        for child in node_children[node]:
+            consumers[node] |= {child} if plan[child] else consumers[child]
 
-def populate_tables(models: list[Type[DataModel]], ctx: Context):
+        cost = durations.get(node.__name__, node.__cost__)
+        if node in models:
+            plan[node], reason = node.__materialize__, "target"
+        elif node.__materialize__:
+            plan[node], reason = True, "declared"
+        elif len(consumers[node]) >= min_consumers and cost >= min_cost:
+            plan[node], reason = True, f"shared by {len(consumers[node])} tables"
+        else:
+            plan[node], reason = False, ""
+        rows.append([node.__name__, len(consumers[node]), cost, plan[node], reason])
+
+    rows.reverse()
+    return plan, rows
+
+
+def show_plan(rows: list[list]) -> None:
+    headers = ["model", "consumers", "cost", "materialize", "reason"]
+    print(tabulate(rows, headers=headers))
+
+
+# -----------------------------------------------------------
+# find the columns of materialized models no one reads
+# -----------------------------------------------------------
+
+
+def plan_columns(
+    models: list[Type[DataModel]],
+    ctx: Context,
+    plan: Optional[dict[Type[DataModel], bool]] = None,
+) -> tuple[dict[str, list[str]], list[list]]:
+    """Find the columns of each materialized model that the models downstream of
+    it read, see `compiler.query_columns`. Non-materialized models are inlined
+    into the materialized ones, so they are covered too.
+
+    Returns the columns to keep for each intermediate table that has columns no
+    one reads, and a row per materialized model describing them. The target
+    models keep all their columns, and every model keeps the columns its strategy
+    needs, like the watermark of an incremental model. Tables read by anything
+    other than the models in this DAG shouldn't be pruned.
+    """
+    node_children, node_parent_count = _build_graph(models)
+    if plan is None:
+        plan = {node: node.__materialize__ for node in node_parent_count}
+    by_name = {node.__name__: node for node in node_parent_count if plan[node]}
+
+    # incremental models are analyzed as a full build
+    ctx = {**ctx, "last_watermark": None}
+    results: dict[Type[DataModel], DataModel] = {}
+    columns: dict[Type[DataModel], list[str]] = {}
+    used: dict[Type[DataModel], set[str]] = {node: set() for node in by_name.values()}
+    for node in topological_order(node_children, node_parent_count):
+        if not plan[node]:
+            results[node] = node(*[results[p] for p in _parent_nodes(node)])
+            continue
+
+        node_instance, query = _build_query(node, results, ctx, True)
+        columns[node], reads = query_columns(query, ctx["catalog"])
+        for table_name, col_names in reads.items():
+            if table_name in by_name:
+                used[by_name[table_name]] |= col_names
+        _attach_table(node_instance, columns[node])
+        results[node] = node_instance
+
+    targets = set(models)
+    keep_columns: dict[str, list[str]] = {}
+    rows = []
+    for node, col_names in columns.items():
+        if node in targets:
+            rows.append([node.__name__, len(col_names), len(col_names), "target"])
+            continue
+        # the strategy of the model reads these from its own table
+        keys = (node.__partition_by__, node.__watermark__, node.__unique_key__)
+        needed = used[node] | {col for col in keys if col is not None}
+        # a table with no columns can't be created, keep one if none are read
+        keep = [col for col in col_names if col in needed] or col_names[:1]
+        unused = [col for col in col_names if col not in keep]
+        if len(unused) > 0:
+            keep_columns[node.__name__] = keep
+        rows.append([node.__name__, len(col_names), len(keep), ", ".join(unused)])
+    return keep_columns, rows
+
+
+def show_column_plan(rows: list[list]) -> None:
+    headers = ["model", "columns", "read downstream", "unused"]
+    print(tabulate(rows, headers=headers))
+
+
+class RunTracker:
+    """Collects an entry with the execution metrics of each model in a run"""
+
+    run_id: Optional[str]
+    started_at: str
+    entries: list[dict[str, Any]]
+    callback: Optional[Callable[[dict[str, Any]], None]]
+
+    def __init__(
+        self, callback: Optional[Callable[[dict[str, Any]], None]] = None
+    ) -> None:
+        self.run_id = None
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self._start = time.perf_counter()
+        self.entries = []
+        self.callback = callback
+
+    def start(self, model: str, persist: bool, queue_wait: float) -> dict[str, Any]:
+        metrics: dict[str, Any] = {
+            "model": model,
+            "materialized": persist,
+            "queue_wait": queue_wait,
+        }
+        if persist:
+            # filled in by the backend once the table is built
+            metrics.update({"rows": None, "bytes": None})
+        return metrics
+
+    def done(
+        self, metrics: dict[str, Any], error: Optional[BaseException] = None
+    ) -> None:
+        if error is not None:
+            metrics["status"] = "error"
+            metrics["error"] = repr(error)
+        self.entries.append(metrics)
+        if self.callback is not None:
+            self.callback(metrics)
+
+    def write(self, path: str) -> None:
+        manifest = {
+            "run_id": self.run_id,
+            "started_at": self.started_at,
+            "elapsed": time.perf_counter() - self._start,
+            "results": self.entries,
+        }
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+
+def populate_tables(
+    models: list[Type[DataModel]],
+    ctx: Context,
+    max_workers: int = 1,
+    durations: Optional[dict[str, float]] = None,
+    skip_unchanged: bool = False,
+    auto_materialize: bool = False,
+    run_results: Optional[str] = None,
+    on_model_done: Optional[Callable[[dict[str, Any]], None]] = None,
+    select: Optional[list[str]] = None,
+    defer: bool = False,
+    resume: bool = False,
+    execute: bool = True,
+    plan_file: Optional[str] = None,
+    prune_columns: bool = False,
+) -> Optional[list[dict[str, Any]]]:
     """Figure out all the dependencies for the set of models provided, do a topological
     sort over the full DAG, and then materialize them in the database.
+
+    With `max_workers` > 1, models that are not blocked on any parent are executed
+    concurrently over a pool of threads. A model is only submitted once all its
+    parents have finished, so the order guarantees are the same as the sequential run.
+
+    Among the models ready to run, the ones heading the longest chain of downstream
+    work are started first. Chain lengths are estimated from `durations`, a mapping
+    of model name to the seconds it took in an earlier run, falling back to the
+    `__cost__` hint on the model class. The mapping is updated in place with the
+    timings of this run, so it can be persisted and passed to the next one.
+
+    With `skip_unchanged`, a fingerprint for each materialized model is recorded in
+    the database, and models whose fingerprint didn't change since the last run
+    reuse the existing table instead of being rebuilt.
+
+    With `auto_materialize`, intermediate models shared by multiple tables are
+    materialized too, see `plan_materialization`. The plan is printed before the
+    models are executed.
+
+    With `prune_columns`, intermediate tables are created with only the columns
+    that the models downstream of them read, see `plan_columns`. Also printed
+    before the models are executed.
+
+    Tables are created through `ctx["backend"]`, which pools connections across
+    models. If none is passed, a sqlite backend for `ctx["db_path"]` is created
+    with a connection per worker, and closed at the end of the run.
+
+    Instead of `ctx["catalog"]`, a `catalog.CatalogLoader` can be passed as
+    `ctx["catalog_loader"]`, to read the catalog from the database. Each table
+    materialized is then registered in it.
+
+    To track the runtime of each model, pass a path to `run_results` to have a json
+    manifest written at the end of the run (also if it fails), and/or a callback
+    `on_model_done` that receives the entry for each model as soon as it is done.
+    Callbacks are invoked from the worker threads.
+
+    To build part of the graph, pass dbt style selectors in `select`, see
+    `select_models`. Unselected models that the selected ones depend on are still
+    built, unless `defer` is set. Then unselected materialized models whose table
+    already exists are treated as built, and the existing table is read instead.
+
+    Each run gets an id, and the materialized models completed in it are logged in
+    the database as they finish. With `resume`, if the last run failed, its id is
+    reused, and the tables it completed are read instead of being built again.
+
+    With `execute=False`, the models are only compiled, see `compile_tables`, and
+    the database isn't touched. The entry for each model is returned. Options that
+    need a database, or only make sense when running the models, can't be used.
     """
-    node_children: dict[Type[DataModel], list[Type[DataModel]]] = defaultdict(list)
-    node_parent_count: dict[Type[DataModel], int] = defaultdict(lambda: 0)
+    if not execute:
+        unsupported = {
+            "skip_unchanged": skip_unchanged,
+            "run_results": run_results is not None,
+            "on_model_done": on_model_done is not None,
+            "defer": defer,
+            "resume": resume,
+        }
+        used = [name for name, value in unsupported.items() if value]
+        assert len(used) == 0, f"can't use {', '.join(used)} with execute=False"
+        return compile_tables(
+            models,
+            ctx,
+            max_workers,
+            auto_materialize,
+            select,
+            plan_file,
+            prune_columns,
+            durations,
+        )
+
+    backend, owned = get_backend(ctx, pool_size=max_workers)
+    tracker = None
+    if run_results is not None or on_model_done is not None:
+        tracker = RunTracker(on_model_done)
+
+    run_log = None
+    try:
+        ctx = {**ctx, "backend": backend}
+        if "catalog_loader" in ctx:
+            ctx["catalog"] = ctx["catalog_loader"].load()
+        run_log = RunLog(backend).start(resume)
+        if tracker is not None:
+            tracker.run_id = run_log.run_id
+        _populate_tables(
+            models,
+            ctx,
+            max_workers,
+            durations,
+            skip_unchanged,
+            auto_materialize,
+            tracker,
+            select,
+            defer,
+            run_log,
+            prune_columns,
+        )
+        run_log.finish()
+    except BaseException as e:
+        if run_log is not None:
+            run_log.finish(error=e)
+        raise
+    finally:
+        if owned:
+            backend.close()
+        if tracker is not None and run_results is not None:
+            tracker.write(run_results)
 
-    seen = set()
-    buffer = [m for m in models]
-    while len(buffer) > 0:
-        model = buffer.pop(0)
-        seen.add(model)
-        if model not in node_parent_count:
-            node_parent_count[model] = 0
 
-        for _, parent in get_parent_models(model):
-            node_children[parent].append(model)
-            node_parent_count[model] += 1
-            if parent not in seen:
-                buffer.append(parent)
+def _populate_tables(
+    models: list[Type[DataModel]],
+    ctx: Context,
+    max_workers: int,
+    durations: Optional[dict[str, float]],
+    skip_unchanged: bool,
+    auto_materialize: bool,
+    tracker: Optional["RunTracker"],
+    select: Optional[list[str]],
+    defer: bool,
+    run_log: RunLog,
+    prune_columns: bool,
+):
+    node_children, node_parent_count = _build_graph(models)
+    state = BuildState(ctx["backend"]).load() if skip_unchanged else None
+    if durations is None:
+        durations = {}
+
+    if auto_materialize:
+        plan, rows = plan_materialization(models, durations)
+        show_plan(rows)
+    else:
+        plan = {node: node.__materialize__ for node in node_parent_count}
+
+    if prune_columns:
+        keep_columns, rows = plan_columns(models, ctx, plan)
+        show_column_plan(rows)
+        ctx = {**ctx, "keep_columns": keep_columns}
+
+    # models whose existing table is read, with their status and columns if known
+    reuse: dict[Type[DataModel], tuple[str, Optional[list[str]]]] = {}
+    selected = set(node_parent_count)
+    if select is not None:
+        selected = select_models(node_children, node_parent_count, select)
+        if defer:
+            tables = ctx["backend"].table_names()
+            for node in node_parent_count:
+                if plan[node] and node not in selected and node.__name__ in tables:
+                    reuse[node] = ("deferred", None)
+    for node in node_parent_count:
+        if plan[node] and node.__name__ in run_log.completed:
+            reuse[node] = ("resumed", run_log.completed[node.__name__])
+
+    if select is not None or len(reuse) > 0:
+        node_children, node_parent_count = _restrict_graph(
+            node_parent_count, selected, set(reuse)
+        )
+    paths = _critical_paths(node_children, node_parent_count, durations, plan)
 
     # iterate over the graph in topological order, materializing each model if specified
     results: dict[Type[DataModel], DataModel] = {}
-    queue = [node for node in node_parent_count if node_parent_count[node] == 0]
+    queue: list[tuple[float, int, Type[DataModel]]] = []
+    counter = itertools.count()  # breaks ties in the order models became ready
+    ready_at: dict[Type[DataModel], float] = {}
 
-    while len(queue) > 0:
-        node = queue.pop(0)
-        parents = [results[p] for _, p in get_parent_models(node)]
-        node_instance = node(*parents)
+    def push(node: Type[DataModel]) -> None:
+        heapq.heappush(queue, (-paths[node], next(counter), node))
+        ready_at[node] = time.perf_counter()
 
-        results[node] = node_instance
-        query = node_instance(ctx)
-        if node.__materialize__:
-            query_rendered: SQLString = render(query, catalog=ctx["catalog"])  # type: ignore
-            table_name = node.__name__
+    def pop() -> Type[DataModel]:
+        return heapq.heappop(queue)[2]
 
-            col_names = db_create_table(table_name, query_rendered.query, ctx)
-            table = SQLTable(S(table_name), [S(col_name) for col_name in col_names])
-            # wrapped in a From node, since the children query uses it directly
-            node_instance.materialized = From(table)
+    def execute(node: Type[DataModel]) -> DataModel:
+        start = time.perf_counter()
+        reused = reuse.get(node)
+        if tracker is None:
+            metrics: dict[str, Any] = {}
+            node_instance = _execute_model(
+                node, results, ctx, plan[node], state, metrics, reused
+            )
+        else:
+            metrics = tracker.start(node.__name__, plan[node], start - ready_at[node])
+            try:
+                node_instance = _execute_model(
+                    node, results, ctx, plan[node], state, metrics, reused
+                )
+            except BaseException as e:
+                tracker.done(metrics, error=e)
+                raise
+            tracker.done(metrics)
+
+        if plan[node] and reused is None:
+            # a skipped model took no time to build, keep its last real duration
+            if metrics["status"] == "built":
+                durations[node.__name__] = time.perf_counter() - start
+            table = node_instance.materialized.source
+            run_log.record(node.__name__, [str(col) for col in table.columns])
+        return node_instance
 
+    def mark_done(node: Type[DataModel]) -> None:
         # go over children, and add them to the queue if they have no parents remaining
         for child in node_children[node]:
             node_parent_count[child] -= 1
             if node_parent_count[child] == 0:
-                queue.append(child)
+                push(child)
         node_children.pop(node)
         node_parent_count.pop(node)
 
+    for node in node_parent_count:
+        if node_parent_count[node] == 0:
+            push(node)
+
+    if max_workers <= 1:
+        while len(queue) > 0:
+            node = pop()
+            results[node] = execute(node)
+            mark_done(node)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running: dict[Future, Type[DataModel]] = {}
+            while len(queue) > 0 or len(running) > 0:
+                while len(queue) > 0 and len(running) < max_workers:
+                    node = pop()
+                    running[pool.submit(execute, node)] = node
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    # re-raises the exception if the model failed, pending ones are
+                    # waited on when the pool shuts down
+                    results[node] = future.result()
+                    mark_done(node)
+
+    assert (
+        len(node_parent_count) == 0
+    ), "data models remaining in the graph that were not visited"
+
+
+def compile_tables(
+    models: list[Type[DataModel]],
+    ctx: Context,
+    max_workers: int = 1,
+    auto_materialize: bool = False,
+    select: Optional[list[str]] = None,
+    plan_file: Optional[str] = None,
+    prune_columns: bool = False,
+    durations: Optional[dict[str, float]] = None,
+) -> list[dict[str, Any]]:
+    """Render the SQL for every materialized model in the DAG, without a database.
+
+    A model's query needs the columns of its materialized parents, which rendering
+    the parents resolves, so models are compiled once their parents are. With
+    `max_workers` > 1, rendering, the pure CPU part of it, is spread over a pool of
+    processes. Queries are still built in this process, since `ctx` can hold values
+    that don't pickle. Incremental models are compiled as a full build.
+
+    `auto_materialize`, `select` and `prune_columns` pick the models and columns
+    the same way as `populate_tables`, with `durations` as the cost estimates.
+
+    Returns an entry per model in topological order, with its parents, columns
+    and SQL, which is also written as json to `plan_file` if given.
+    """
+    node_children, node_parent_count = _build_graph(models)
+    if auto_materialize:
+        plan, rows = plan_materialization(models, durations)
+        show_plan(rows)
+    else:
+        plan = {node: node.__materialize__ for node in node_parent_count}
+    keep_columns: dict[str, list[str]] = {}
+    if prune_columns:
+        keep_columns, rows = plan_columns(models, ctx, plan)
+        show_column_plan(rows)
+    if select is not None:
+        selected = select_models(node_children, node_parent_count, select)
+        node_children, node_parent_count = _restrict_graph(
+            node_parent_count, selected, set()
+        )
+
+    ctx = {**ctx, "last_watermark": None}
+    catalog: SQLCatalog = ctx["catalog"]
+    cache = ctx.get("render_cache")
+    results: dict[Type[DataModel], DataModel] = {}
+    rendered: dict[Type[DataModel], tuple[SQLString, list[str]]] = {}
+    parent_count = dict(node_parent_count)
+    ready = deque(node for node, count in parent_count.items() if count == 0)
+
+    def finish(node: Type[DataModel], node_instance: DataModel) -> None:
+        results[node] = node_instance
+        for child in node_children[node]:
+            parent_count[child] -= 1
+            if parent_count[child] == 0:
+                ready.append(child)
+
+    def attach(node: Type[DataModel], node_instance: DataModel, entry: tuple) -> None:
+        rendered[node] = entry
+        _attach_table(node_instance, entry[1])
+        finish(node, node_instance)
+
+    pool_cm = ProcessPoolExecutor(max_workers) if max_workers > 1 else nullcontext()
+    with pool_cm as pool:
+        running: dict[Future, tuple[Type[DataModel], DataModel, Optional[str]]] = {}
+        while len(ready) > 0 or len(running) > 0:
+            while len(ready) > 0:
+                node = ready.popleft()
+                if not plan[node]:
+                    finish(node, node(*[results[p] for p in _parent_nodes(node)]))
+                    continue
+
+                node_instance, query = _build_query(node, results, ctx, True)
+                keep = keep_columns.get(node.__name__)
+                if keep is not None:
+                    query = query >> Select(*[Get(col_name) for col_name in keep])
+                key = None if cache is None else query_key(query, catalog)
+                entry = None if key is None else cache.get(key)
+                if entry is not None:
+                    attach(node, node_instance, entry)
+                elif pool is None:
+                    entry = render_query(query, catalog)
+                    if key is not None:
+                        cache.put(key, entry)
+                    attach(node, node_instance, entry)
+                else:
+                    future = pool.submit(render_query, query, catalog)
+                    running[future] = (node, node_instance, key)
+
+            if len(running) > 0:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, node_instance, key = running.pop(future)
+                    entry = future.result()
+                    if key is not None:
+                        cache.put(key, entry)
+                    attach(node, node_instance, entry)
+
+    entries = []
+    for node in topological_order(node_children, node_parent_count):
+        entry: dict[str, Any] = {
+            "model": node.__name__,
+            "materialized": plan[node],
+            "parents": [parent.__name__ for parent in _parent_nodes(node)],
+            "columns": [],
+            "query": None,
+            "variables": [],
+        }
+        if node in rendered:
+            query_rendered, col_names = rendered[node]
+            entry["columns"] = col_names
+            entry["query"] = query_rendered.query
+            entry["variables"] = [str(name) for name in query_rendered.variables]
+        entries.append(entry)
+    if plan_file is not None:
+        with open(plan_file, "w") as f:
+            json.dump(entries, f, indent=2)
+    return entries
+
+
+async def populate_tables_async(
+    models: list[Type[DataModel]], ctx: Context, max_concurrency: int = 4
+):
+    """Asyncio variant of `populate_tables`. Each model in the DAG is scheduled as a
+    task that awaits its parent tasks.
+
+    Tables are created at most as many at a time as the backend has connections,
+    a cap shared by all the builds running on the same backend. Without a backend
+    in the context, one is created with `max_concurrency` connections.
+    """
+    backend, owned = get_backend(ctx, pool_size=max_concurrency)
+    try:
+        await _populate_tables_async(models, {**ctx, "backend": backend})
+    finally:
+        if owned:
+            backend.close()
+
+
+async def _populate_tables_async(models: list[Type[DataModel]], ctx: Context):
+    node_children, node_parent_count = _build_graph(models)
+    semaphore = ctx["backend"].async_slots()
+    results: dict[Type[DataModel], DataModel] = {}
+
+    async def execute(node: Type[DataModel]) -> DataModel:
+        for _, parent in get_parent_models(node):
+            await tasks[parent]
+
+        persist = node.__materialize__
+        if persist and node.__strategy__ not in ("replace", "swap"):
+            # incremental and partitioned models read the existing table before
+            # building, so they go through the same code as `populate_tables`
+            async with semaphore:
+                node_instance = await asyncio.to_thread(
+                    _execute_model, node, results, ctx, persist
+                )
+            results[node] = node_instance
+            return node_instance
+
+        node_instance, _, query_rendered, col_names = _compile_model(
+            node, results, ctx, persist
+        )
+        if query_rendered is not None:
+            async with semaphore:
+                await db_create_table_async(
+                    node.__name__, query_rendered.query, ctx, node.__strategy__
+                )
+            _attach_table(node_instance, col_names)
+
+        results[node] = node_instance
+        return node_instance
+
+    # tasks are created in topological order, so parent tasks always exist already
+    tasks: dict[Type[DataModel], asyncio.Task] = {}
+    queue = deque(node for node in node_parent_count if node_parent_count[node] == 0)
+    while len(queue) > 0:
+        node = queue.popleft()
+        tasks[node] = asyncio.create_task(execute(node))
+        for child in node_children[node]:
+            node_parent_count[child] -= 1
+            if node_parent_count[child] == 0:
+                queue.append(child)
+        node_parent_count.pop(node)
+
     assert (
         len(node_parent_count) == 0
     ), "data models remaining in the graph that were not visited"
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
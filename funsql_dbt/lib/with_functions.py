@@ -0,0 +1,223 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Iterator, Optional
+
+from funsql import *
+
+from .backends import Backend
+from .compiler import RenderCache, render_query
+
+
+# -----------------------------------------------------------
+# utilities to run data models written as plain functions
+# -----------------------------------------------------------
+
+
+class ModelRun:
+    """State shared by all the model functions called during a single run.
+
+    Results are memoized by the function and the arguments it was called with, so
+    a model used by several others has its query built once, and a materialized
+    model creates its table once. Each result is a future, so if models are called
+    from several threads, only the first caller does the work and the rest wait.
+
+    When tracing, materialized models are compiled but not executed. The table
+    handle they return only needs the output columns, which compiling resolves, so
+    the model functions run unchanged. The rendered queries and the materialized
+    models each of them called make up the graph, which `execute` then runs.
+    """
+
+    backend: Backend
+    catalog: SQLCatalog
+    trace: bool
+    render_cache: Optional[RenderCache]
+    results: dict[tuple, Future]
+    tasks: dict[str, tuple[str, str]]  # table -> (rendered query, strategy)
+    parents: dict[str, set[str]]
+
+    def __init__(
+        self,
+        backend: Backend,
+        catalog: SQLCatalog,
+        trace: bool = False,
+        render_cache: Optional[RenderCache] = None,
+    ) -> None:
+        self.backend = backend
+        self.catalog = catalog
+        self.trace = trace
+        self.render_cache = render_cache
+        self.results = {}
+        self.tasks = {}
+        self.parents = {}
+        self._lock = threading.Lock()
+
+    def call(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        try:
+            key = (func, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            # unhashable arguments, can't tell if it is the same call
+            return func(*args, **kwargs)
+
+        with self._lock:
+            fut = self.results.get(key)
+            owner = fut is None
+            if owner:
+                fut = self.results[key] = Future()
+
+        if owner:
+            # also remember the materialized models reached, so callers served
+            # from the memo still get them as dependencies
+            token = _parents_scope.set(set())
+            try:
+                result = func(*args, **kwargs)
+                fut.set_result((result, _parents_scope.get()))
+            except BaseException as e:
+                fut.set_exception(e)
+                raise
+            finally:
+                _parents_scope.reset(token)
+
+        result, reached = fut.result()
+        parents = _parents_scope.get()
+        if parents is not None:
+            parents.update(reached)
+        return result
+
+    def execute(self, max_workers: int = 1) -> None:
+        """create the tables recorded when tracing, running the ones whose parents
+        are done over a pool of threads
+        """
+        parent_count = {table: len(parents) for table, parents in self.parents.items()}
+        children: dict[str, list[str]] = defaultdict(list)
+        for table, parents in self.parents.items():
+            for parent in parents:
+                children[parent].append(table)
+
+        ready = [table for table, count in parent_count.items() if count == 0]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running: dict[Future, str] = {}
+            while len(ready) > 0 or len(running) > 0:
+                for table in ready:
+                    query_rendered, strategy = self.tasks[table]
+                    fut = pool.submit(
+                        self.backend.create_table, table, query_rendered, strategy
+                    )
+                    running[fut] = table
+                ready = []
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    table = running.pop(fut)
+                    fut.result()  # raise the first error, pending tables are skipped
+                    for child in children[table]:
+                        parent_count[child] -= 1
+                        if parent_count[child] == 0:
+                            ready.append(child)
+
+
+_current_run: ContextVar[Optional[ModelRun]] = ContextVar("_current_run", default=None)
+
+# materialized models called by the materialized model being built
+_parents_scope: ContextVar[Optional[set[str]]] = ContextVar(
+    "_parents_scope", default=None
+)
+
+
+@contextmanager
+def model_run(
+    backend: Backend,
+    catalog: SQLCatalog,
+    trace: bool = False,
+    render_cache: Optional[RenderCache] = None,
+) -> Iterator[ModelRun]:
+    """scope for a run of the models, tables are created in the given backend.
+    Pass a render cache to keep rendered queries across runs.
+    """
+    run = ModelRun(backend, catalog, trace, render_cache)
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+
+def model(func: Callable[..., SQLNode]) -> Callable[..., SQLNode]:
+    """Decorator for a model function that isn't materialized. Inside a run, the
+    query is built once and reused by all the models calling it.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        run = _current_run.get()
+        if run is None:
+            return func(*args, **kwargs)
+        return run.call(func, args, kwargs)
+
+    return wrapper
+
+
+def materialize(table_name: str, strategy: str = "replace"):
+    """Decorator for a model function whose output is materialized as a table. The
+    table is created the first time the model is called in a run, and later calls
+    get the same table back.
+    """
+
+    def decorator(func: Callable[..., SQLNode]) -> Callable[..., SQLNode]:
+        def build(*args, **kwargs) -> SQLNode:
+            run = _current_run.get()
+            token = _parents_scope.set(set())
+            try:
+                query: SQLNode = func(*args, **kwargs)
+                parents = _parents_scope.get()
+            finally:
+                _parents_scope.reset(token)
+
+            # the schema of the table is resolved when compiling the query
+            cache = run.render_cache
+            render = render_query if cache is None else cache.render
+            query_rendered, col_names = render(query, run.catalog)
+            if run.trace:
+                run.tasks[table_name] = (query_rendered.query, strategy)
+                run.parents[table_name] = parents
+            else:
+                run.backend.create_table(table_name, query_rendered.query, strategy)
+            return From(
+                SQLTable(S(table_name), [S(col_name) for col_name in col_names])
+            )  # wrapped in a From node, since the children query uses it directly
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            run = _current_run.get()
+            assert run is not None, f"{table_name}: call models inside a `model_run`"
+            # recorded before the memo lookup, a cached model is still a dependency
+            parents = _parents_scope.get()
+            if parents is not None:
+                parents.add(table_name)
+            return run.call(build, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def populate_functions(
+    models: list[Callable[[], Any]],
+    backend: Backend,
+    catalog: SQLCatalog,
+    max_workers: int = 1,
+    render_cache: Optional[RenderCache] = None,
+) -> None:
+    """Materialize the given model functions, and the materialized models they
+    depend on. A first pass calls the functions without touching the database, to
+    discover the graph of materialized models, which are then created concurrently,
+    each once its parents are done.
+    """
+    with model_run(backend, catalog, trace=True, render_cache=render_cache) as run:
+        for model_func in models:
+            model_func()
+    run.execute(max_workers)
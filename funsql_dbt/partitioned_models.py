@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+
+from funsql import *
+
+from class_models import DB_CATALOG, order_payments, stg_orders
+from lib.backends import DuckDBBackend, SQLiteBackend
+from lib.catalog import CatalogLoader
+from lib.seed import seed_tables
+from lib.with_classes import Context, DataModel, in_partition, populate_tables
+
+
+# -----------------------------------------------------------
+# The orders of the `jaffle` project, in a table built a month
+# at a time. Reruns only compute the months whose source rows
+# changed, and only rewrite those whose output did.
+# -----------------------------------------------------------
+
+
+class orders_by_month(DataModel):
+    __materialize__ = True
+    __strategy__ = "partition"
+    __partition_by__ = "order_date"
+    __partition_grain__ = "month"
+    orders: stg_orders
+    payments: order_payments
+
+    def partitions(self, ctx: Context) -> SQLNode:
+        # the months are all in the orders, no need to join the payments
+        return self.orders(ctx)
+
+    def query(self, ctx: Context) -> SQLNode:
+        # only the orders of the month being built are read
+        orders = in_partition(self.orders(ctx), ctx, "order_date")
+        return (
+            orders
+            >> Join(
+                self.payments(ctx) >> As(S.payments),
+                on=Fun("=", Get.order_id, Get.payments.order_id),
+                left=True,
+            )
+            >> Select(
+                Get.order_id,
+                Get.customer_id,
+                Get.order_date,
+                Get.status,
+                aka(Get.payments.total_amount, "amount"),
+            )
+        )
+
+
+def show_partitions(entry: dict) -> None:
+    if "partitions" in entry:
+        print(f"{entry['model']}: {entry['partitions']} partitions written")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["run", "seed"], nargs="?", default="run")
+    parser.add_argument("--backend", choices=["sqlite", "duckdb"], default="sqlite")
+    args = parser.parse_args()
+
+    if args.backend == "duckdb":
+        DB_FILE = "/tmp/funsql_partitioned_models.duckdb"
+        db_exists = os.path.exists(DB_FILE)
+        backend = DuckDBBackend(DB_FILE, pool_size=4)
+    else:
+        DB_FILE = "/tmp/funsql_partitioned_models.db"
+        db_exists = os.path.exists(DB_FILE)
+        backend = SQLiteBackend(DB_FILE, pool_size=4)
+
+    # create tables for csv files, if the database didn't exist
+    if args.command == "seed" or not db_exists:
+        seed_tables(backend, DB_CATALOG, ".")
+    if args.command == "seed":
+        backend.close()
+        sys.exit(0)
+
+    populate_tables(
+        [orders_by_month],
+        {
+            "backend": backend,
+            "catalog_loader": CatalogLoader(backend),
+            "payment_methods": ["credit_card", "coupon", "bank_transfer", "gift_card"],
+        },
+        max_workers=4,
+        on_model_done=show_partitions,
+    )
+    backend.close()
@@ -0,0 +1,51 @@
+import os
+import sys
+from typing import Any, Callable
+
+import pytest
+
+# the models and lib are imported the way the sample projects do, from this folder
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import class_models  # noqa: E402
+from lib.backends import SQLiteBackend  # noqa: E402
+from lib.seed import seed_tables  # noqa: E402
+from lib.with_classes import populate_tables  # noqa: E402
+
+PAYMENT_METHODS = ["credit_card", "coupon", "bank_transfer", "gift_card"]
+
+
+@pytest.fixture
+def backend(tmp_path):
+    """sqlite database seeded with the sample csv files"""
+    backend = SQLiteBackend(str(tmp_path / "models.db"))
+    seed_tables(backend, class_models.DB_CATALOG, PROJECT_DIR)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def run(backend) -> Callable[..., dict[str, str]]:
+    """Run the models against the seeded database, and return the status each
+    one finished with. Context values can be overridden as keyword arguments.
+    """
+
+    def run_models(models: list, ctx: dict[str, Any] = {}, **kwargs) -> dict:
+        statuses: dict[str, str] = {}
+        populate_tables(
+            models,
+            {
+                "backend": backend,
+                "catalog": class_models.DB_CATALOG,
+                "payment_methods": PAYMENT_METHODS,
+                **ctx,
+            },
+            on_model_done=lambda entry: statuses.update(
+                {entry["model"]: entry["status"]}
+            ),
+            **kwargs,
+        )
+        return statuses
+
+    return run_models
@@ -0,0 +1,116 @@
+import pytest
+
+from class_models import DB_CATALOG
+from conftest import PAYMENT_METHODS
+from lib.state import PARTITIONS_TABLE
+from lib.with_classes import populate_tables
+from partitioned_models import orders_by_month
+
+MONTHS = ["2018-01", "2018-02", "2018-03", "2018-04"]
+
+
+def build(backend) -> str:
+    """build the partitioned orders, and return how many partitions were written"""
+    entries = {}
+    populate_tables(
+        [orders_by_month],
+        {
+            "backend": backend,
+            "catalog": DB_CATALOG,
+            "payment_methods": PAYMENT_METHODS,
+        },
+        on_model_done=lambda entry: entries.update({entry["model"]: entry}),
+    )
+    return entries["orders_by_month"]["partitions"]
+
+
+def full_query_rows(backend) -> list[tuple]:
+    """the rows of the model built in one go, without partitions"""
+    entries = populate_tables(
+        [orders_by_month],
+        {"catalog": DB_CATALOG, "payment_methods": PAYMENT_METHODS},
+        execute=False,
+    )
+    query = next(e["query"] for e in entries if e["model"] == "orders_by_month")
+    return sorted(backend.execute(query), key=repr)
+
+
+def table_rows(backend) -> list[tuple]:
+    return sorted(backend.execute("SELECT * FROM orders_by_month"), key=repr)
+
+
+@pytest.fixture
+def built_months(backend, monkeypatch) -> list[str]:
+    """the months each partition query is run for"""
+    months = []
+    build_partition = backend.build_partition
+
+    def spy(table_name, query_rendered, params, partition_key, value, *args):
+        months.append(value)
+        return build_partition(
+            table_name, query_rendered, params, partition_key, value, *args
+        )
+
+    monkeypatch.setattr(backend, "build_partition", spy)
+    return months
+
+
+def test_first_build_matches_full_query(backend, built_months):
+    assert build(backend) == "4/4"
+    assert sorted(built_months) == MONTHS
+    assert table_rows(backend) == full_query_rows(backend)
+
+
+def test_rerun_computes_nothing(backend, built_months):
+    build(backend)
+    built_months.clear()
+    assert build(backend) == "0/4"
+    assert built_months == []
+
+
+def test_changed_rows_only_rewrite_their_partition(backend):
+    build(backend)
+    backend.execute("UPDATE raw_orders SET status = 'lost' WHERE id = 5")
+    assert build(backend) == "1/4"
+    assert table_rows(backend) == full_query_rows(backend)
+
+
+def test_partitions_gone_are_deleted(backend):
+    build(backend)
+    backend.execute("DELETE FROM raw_orders WHERE order_date >= '2018-04'")
+    assert build(backend) == "0/3"
+    assert table_rows(backend) == full_query_rows(backend)
+    rows = backend.execute(f"SELECT partition_value FROM {PARTITIONS_TABLE}")
+    assert sorted(value for value, in rows) == MONTHS[:3]
+
+
+def test_failed_build_resumes(backend, built_months, monkeypatch):
+    build_partition = backend.build_partition
+
+    def fail_march(table_name, query_rendered, params, partition_key, value, *args):
+        if value == "2018-03":
+            raise RuntimeError("interrupted")
+        return build_partition(
+            table_name, query_rendered, params, partition_key, value, *args
+        )
+
+    with monkeypatch.context() as patch:
+        patch.setattr(backend, "build_partition", fail_march)
+        with pytest.raises(RuntimeError):
+            build(backend)
+
+    built_months.clear()
+    assert build(backend) == "1/4"
+    assert built_months == ["2018-03"]
+    assert table_rows(backend) == full_query_rows(backend)
+
+
+def test_compiled_as_a_full_build():
+    entries = populate_tables(
+        [orders_by_month],
+        {"catalog": DB_CATALOG, "payment_methods": PAYMENT_METHODS},
+        execute=False,
+    )
+    query = next(e["query"] for e in entries if e["model"] == "orders_by_month")
+    # outside of a partitioned run, no rows are filtered out
+    assert "SUBSTR" not in query
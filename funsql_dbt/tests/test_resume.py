@@ -0,0 +1,67 @@
+import pytest
+
+from class_models import customer_final, orders_final
+from lib.state import RUNS_TABLE
+
+MODELS = [orders_final, customer_final]
+
+
+class Boom(Exception):
+    pass
+
+
+def fail_customer_final(monkeypatch):
+    def query(self, ctx):
+        raise Boom("transient")
+
+    monkeypatch.setattr(customer_final, "query", query)
+
+
+def materialized(statuses):
+    return {model: s for model, s in statuses.items() if s != "ephemeral"}
+
+
+def test_failed_run_is_logged(run, backend, monkeypatch):
+    fail_customer_final(monkeypatch)
+    with pytest.raises(Boom):
+        run(MODELS)
+    rows = backend.execute(f"SELECT status, error FROM {RUNS_TABLE}")
+    assert rows == [("error", "Boom('transient')")]
+
+
+def test_resume_reuses_completed_tables(run, backend, monkeypatch):
+    with monkeypatch.context() as patch:
+        fail_customer_final(patch)
+        with pytest.raises(Boom):
+            run(MODELS)
+
+    statuses = run(MODELS, resume=True)
+    assert materialized(statuses) == {
+        "order_payments": "resumed",
+        "customer_payments": "resumed",
+        "orders_final": "resumed",
+        "customer_final": "built",
+    }
+    # the failed run is picked up, and now succeeded
+    rows = backend.execute(f"SELECT status FROM {RUNS_TABLE}")
+    assert rows == [("success",)]
+
+
+def test_resume_rebuilds_dropped_tables(run, backend, monkeypatch):
+    with monkeypatch.context() as patch:
+        fail_customer_final(patch)
+        with pytest.raises(Boom):
+            run(MODELS)
+
+    backend.execute("DROP TABLE customer_payments")
+    statuses = run(MODELS, resume=True)
+    assert statuses["customer_payments"] == "built"
+    assert statuses["order_payments"] == "resumed"
+
+
+def test_resume_after_success_builds_everything(run, backend):
+    run(MODELS)
+    statuses = run(MODELS, resume=True)
+    assert set(materialized(statuses).values()) == {"built"}
+    rows = backend.execute(f"SELECT status FROM {RUNS_TABLE}")
+    assert rows == [("success",), ("success",)]
@@ -0,0 +1,81 @@
+import csv
+import os
+
+import class_models
+from class_models import TABLE_PAYMENTS, customer_final, order_payments
+from lib.state import STATE_TABLE
+
+
+def test_unchanged_models_are_skipped(run):
+    statuses = run([customer_final], skip_unchanged=True)
+    assert statuses["customer_final"] == "built"
+    statuses = run([customer_final], skip_unchanged=True)
+    assert statuses["customer_final"] == "skipped"
+    assert statuses["customer_payments"] == "skipped"
+
+
+def test_context_change_rebuilds(run, backend):
+    run([order_payments], skip_unchanged=True)
+    statuses = run(
+        [order_payments], {"payment_methods": ["credit_card"]}, skip_unchanged=True
+    )
+    assert statuses["order_payments"] == "built"
+    assert backend.table_columns("order_payments") == [
+        "order_id",
+        "credit_card_amount",
+        "total_amount",
+    ]
+
+
+def test_table_rebuilt_without_state_is_not_skipped(run, backend):
+    methods = {"payment_methods": ["credit_card", "coupon"]}
+    run([order_payments], methods, skip_unchanged=True)
+    # rebuilt by a run that doesn't keep the build state
+    run([order_payments], {"payment_methods": ["credit_card"]})
+    statuses = run([order_payments], methods, skip_unchanged=True)
+
+    assert statuses["order_payments"] == "built"
+    assert "coupon_amount" in backend.table_columns("order_payments")
+
+
+def test_table_written_in_place_is_not_skipped(run, backend):
+    run([order_payments], skip_unchanged=True)
+    backend.execute("UPDATE order_payments SET total_amount = 0")
+    statuses = run([order_payments], skip_unchanged=True)
+
+    assert statuses["order_payments"] == "built"
+    rows = backend.execute("SELECT count(*) FROM order_payments WHERE total_amount = 0")
+    assert rows[0][0] < 10
+
+
+def test_reseed_with_same_row_count_rebuilds(run, backend, tmp_path):
+    run([order_payments], skip_unchanged=True)
+
+    # reload the payments with the same rows, but one amount changed
+    seed_dir = os.path.dirname(class_models.__file__)
+    with open(os.path.join(seed_dir, "raw_payments.csv"), newline="") as f:
+        rows = list(csv.reader(f))
+    header, first = rows[0], rows[1]
+    first[header.index("amount")] = "123456"
+    with open(tmp_path / "raw_payments.csv", "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+    columns = [str(col) for col in TABLE_PAYMENTS.columns]
+    backend.load_csv("raw_payments", columns, str(tmp_path / "raw_payments.csv"))
+
+    statuses = run([order_payments], skip_unchanged=True)
+    assert statuses["order_payments"] == "built"
+    order_id = int(first[header.index("order_id")])
+    rows = backend.execute(
+        "SELECT total_amount FROM order_payments WHERE order_id = ?", (order_id,)
+    )
+    assert rows[0][0] >= 1234
+
+
+def test_state_recorded_without_table_versions_is_reset(run, backend):
+    backend.execute(
+        f"CREATE TABLE {STATE_TABLE} "
+        "(model TEXT PRIMARY KEY, fingerprint TEXT, columns TEXT)"
+    )
+    statuses = run([order_payments], skip_unchanged=True)
+    assert statuses["order_payments"] == "built"
+    assert "version" in backend.table_columns(STATE_TABLE)